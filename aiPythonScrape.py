@@ -1,33 +1,65 @@
 import os.path
 import sys
+import argparse
 import requests
-from bs4 import BeautifulSoup
-import pandas as pd
 import xml.etree.ElementTree as ET
 import time
-from tqdm import tqdm
 import re
-from tkinter import filedialog, Tk
+import sqlite3
+import threading
+import queue
+import multiprocessing
+import itertools
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
 import logging
-import colorlog
-
-class Kirke:
-    def __init__(self):
-        self.kirke_id = None
-        self.kirke_navn = None
-        self.kirke_addr1 = None
-        self.kirke_addr2 = None
-        self.kirke_postnr = None
-        self.kirke_by = None
-        self.kirke_lat = None
-        self.kirke_lng = None
-        self.sogne_id = None
-        self.sogne_navn = None
-        self.sogndk_url= None
-        self.provsti_id = None
-        self.provsti_navn = None
-        self.staff = []
-        self.account_status = ""
+from http_transport import create_transport, get_default_transport, MAX_RETRY_AFTER, TRANSPORTS, DEFAULT_TRANSPORT
+from http_cache import ResponseCache, DEFAULT_MAX_AGE, DEFAULT_MAX_SIZE
+from exporters import write_rows, write_table, write_sheets, sheet_path, format_from_path, EXPORT_FORMATS
+from journal import ScrapeJournal, resume_from_journal, DEFAULT_JOURNAL_PATH
+from metrics import METRICS
+from snapshot import StaffSnapshot, CHANGE_COLUMNS, DEFAULT_SNAPSHOT_PATH
+from persons import person_sheets
+from store import KirkeStore, DEFAULT_STORE_PATH
+from shards import ShardQueue, worker_name, SHARD_KEYS, DEFAULT_SHARD_KEY, DEFAULT_SHARDS, DEFAULT_LEASE
+from records import (Kirke, Staff, KirkeTable, KIRKE_FIELDS, KIRKE_EXPORT_FIELDS, STAFF_FIELDS, EXPORT_KEY_COLUMNS,
+                     EXPORT_COLUMNS, parse_float, clean_status, sogne_keys)
+
+# pandas, numpy (spatial), bs4, tqdm, colorlog and tkinter are imported inside the functions that use them, so the
+# headless commands (and the frozen exe) start without loading what they don't need.
+
+FEED_URL = "http://sogn.dk/xmlfeeds/kirker.php"
+
+# Defaults for the concurrent staff scrape, overridable with --concurrency and --rate
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RATE = 2.0
+# Adaptive rate control (--adaptive-rate): the rate starts at --rate and moves between
+# MIN_ADAPTIVE_RATE and --max-rate depending on how the server copes
+DEFAULT_MAX_RATE = 10.0
+MIN_ADAPTIVE_RATE = 0.2
+DEFAULT_TARGET_LATENCY = 1.0
+# Churches in flight at once in a streaming run (--stream)
+DEFAULT_WINDOW = 256
+# 0 parses staff pages in the download threads; more starts a process pool of parsers (--parse-workers)
+DEFAULT_PARSE_WORKERS = 0
+
+# Columns of the 'nearby' command's output: the query point, then each matching church
+NEARBY_COLUMNS = ("point", "point_lat", "point_lng", "rank", "distance_km") + KIRKE_FIELDS
+
+# The classes inside a person_data block that map one-to-one onto Staff attributes
+STAFF_CLASSES = ("navn", "stilling", "adr1", "postnr_by", "email", "tlf")
+# Matches the class attribute of a person_data block whether or not the parser has split it yet
+PERSON_DATA_CLASS = re.compile(r"(^|\s)person_data(\s|$)")
+# Text nodes that BeautifulSoup's .text includes: not comments, and nothing inside script, style or template
+LXML_TEXT = "descendant-or-self::text()[not(ancestor::script or ancestor::style or ancestor::template)]"
+# A tag, or a carriage return outside of tags
+TEXT_CR = re.compile(r"(<[^>]*>)|\r")
+# html.parser shrinks a text node of nothing but these characters to one newline or space,
+# except inside the tags that keep their whitespace
+HTML_SPACES = " \n\t\x0c\r"
+WHITESPACE_TAGS = "ancestor-or-self::pre or ancestor-or-self::textarea"
 
 '''
 <div class="person_data">
@@ -40,79 +72,715 @@ class Kirke:
     <div class="my-6"><a><font><font>Secure inquiry</font></font></a></div>
 </div>
 '''
-class Staff:
-    def __init__(self):
-        self.stilling = None
-        self.navn = None
-        self.adr1 = None
-        self.postnr_by = None
-        self.email = None
-        self.tlf = None
 
-
-def get_xml_data(url, logger):
+@METRICS.timed("feed_download")
+def get_xml_data(url, logger, transport=None):
+    transport = transport or get_default_transport()
     try:
-        with requests.sessions.Session() as session:
-            response = session.get(url)
-            response.raise_for_status()
-            return response.text
+        response = transport.get(url)
+        response.raise_for_status()
+        return response.text
     except requests.exceptions.RequestException as e:
         logger.error("An error occurred while retrieving the data: %s", e)
         return None
 
+# Maps each child tag of a <kirke> record to the Kirke attribute it fills and an optional converter
+KIRKE_XML_FIELDS = {
+    "kirkeId": ("kirke_id", int),
+    "kirkenavn": ("kirke_navn", None),
+    "kirkeaddr1": ("kirke_addr1", None),
+    "kirkeaddr2": ("kirke_addr2", None),
+    "kirkepostnr": ("kirke_postnr", int),
+    "kirkeby": ("kirke_by", None),
+    "lat": ("kirke_lat", parse_float),
+    "lng": ("kirke_lng", parse_float),
+    "provstiId": ("provsti_id", int),
+    "provstinavn": ("provsti_navn", None),
+    "sogneId": ("sogne_id", int),
+    "sognenavn": ("sogne_navn", None),
+    "sogndkurl": ("sogndk_url", None),
+}
+
+def kirke_from_element(element):
+    # Fill a Kirke in a single pass over the children of a <kirke> element
+    k = Kirke()
+    for child in element:
+        field = KIRKE_XML_FIELDS.get(child.tag)
+        if field is not None:
+            name, convert = field
+            setattr(k, name, convert(child.text) if convert else child.text)
+    return k
+
+def iter_kirke_xml(chunks):
+    # Incrementally parse the kirker.php feed from an iterable of bytes (or str) chunks and yield
+    # each Kirke as soon as its <kirke> element closes. Processed elements are cleared from the
+    # tree, so memory stays flat however large the feed grows.
+    parser = ET.XMLPullParser(events=("start", "end"))
+    root = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            elif event == "end" and element.tag == "kirke":
+                yield kirke_from_element(element)
+                root.clear()
+    parser.close()
+
+@METRICS.timed("feed_parse")
 def parse_kirke_xml(xml_data, kirker):
-    root = ET.fromstring(xml_data)
-    for kirke in root.findall("./kirke"):
-        k = Kirke()
-        k.kirke_id = int(kirke.find("kirkeId").text)
-        k.kirke_navn = kirke.find("kirkenavn").text
-        k.kirke_addr1 = kirke.find("kirkeaddr1").text
-        k.kirke_addr2 = kirke.find("kirkeaddr2").text
-        k.kirke_postnr = int(kirke.find("kirkepostnr").text)
-        k.kirke_by = kirke.find("kirkeby").text
-        k.kirke_lat = kirke.find("lat").text
-        k.kirke_lng = kirke.find("lng").text
-        k.provsti_id = int(kirke.find("provstiId").text)
-        k.provsti_navn = kirke.find("provstinavn").text
-        k.sogne_id = int(kirke.find("sogneId").text)
-        k.sogne_navn = kirke.find("sognenavn").text
-        k.sogndk_url = kirke.find("sogndkurl").text
-        kirker.append(k)
+    kirker.extend(iter_kirke_xml([xml_data]))
+
+def stream_kirke_xml(url, logger, transport=None, chunk_size=64 * 1024):
+    # Download the feed and parse it while it arrives. Yields Kirke objects; on a network
+    # or XML error the error is logged and the generator stops.
+    transport = transport or get_default_transport()
+    try:
+        response = transport.get(url, stream=True)
+        with response:
+            # Inside the with, so an error status still closes the response and frees its connection
+            response.raise_for_status()
+            yield from iter_kirke_xml(transport.iter_content(response, chunk_size))
+    except requests.exceptions.RequestException as e:
+        logger.error("An error occurred while retrieving the data: %s", e)
+    except ET.ParseError as e:
+        logger.error("An error occurred while parsing the data: %s", e)
 
 def get_text_or_empty(element):
     return element.text if element else ""
 
-def scrape_priests(kirke, logger):
+def staff_from_person_data(person_data):
+    # Find the first descendant for each staff class in one walk over the block. This picks the
+    # same elements as calling person_data.find(class_=...) once per class.
+    found = {}
+    for tag in person_data.find_all(True):
+        for css_class in tag.get("class", ()):
+            if css_class in STAFF_CLASSES and css_class not in found:
+                found[css_class] = tag
+        if len(found) == len(STAFF_CLASSES):
+            break
+    new_staff = Staff()
+    for css_class in STAFF_CLASSES:
+        setattr(new_staff, css_class, get_text_or_empty(found.get(css_class)))
+    return new_staff
+
+def parse_staff_bs4(content):
+    # Reference parser: full BeautifulSoup tree and one find() per field
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, "html.parser")
+    staff = []
+    for person_data in soup.find_all(class_="person_data"):
+        new_staff = Staff()
+        new_staff.navn = get_text_or_empty(person_data.find(class_="navn"))
+        new_staff.stilling = get_text_or_empty(person_data.find(class_="stilling"))
+        new_staff.adr1 = get_text_or_empty(person_data.find(class_="adr1"))
+        new_staff.postnr_by = get_text_or_empty(person_data.find(class_="postnr_by"))
+        new_staff.email = get_text_or_empty(person_data.find(class_="email"))
+        new_staff.tlf = get_text_or_empty(person_data.find(class_="tlf"))
+        staff.append(new_staff)
+    return staff
+
+def parse_staff_strainer(content):
+    # Only the person_data subtrees are built, and each is read in a single pass
+    from bs4 import BeautifulSoup, SoupStrainer
+    soup = BeautifulSoup(content, "html.parser", parse_only=SoupStrainer(attrs={"class": PERSON_DATA_CLASS}))
+    return [staff_from_person_data(person_data) for person_data in soup.find_all(class_="person_data")]
+
+def lxml_text(element):
+    # The text of an lxml element the way BeautifulSoup's .text reads it, including the
+    # shrinking of whitespace-only text nodes (the indentation between tags)
+    texts = []
+    for text in element.xpath(LXML_TEXT):
+        if not text.strip(HTML_SPACES):
+            # A tail belongs to the parent of the element it follows
+            holder = text.getparent()
+            if text.is_tail:
+                holder = holder.getparent()
+            if holder is None or not holder.xpath(WHITESPACE_TAGS):
+                text = "\n" if "\n" in text else " "
+        texts.append(text)
+    return "".join(texts)
+
+def parse_staff_lxml(content):
+    # libxml2-based path. Needs the optional lxml package. The page is decoded the same way
+    # BeautifulSoup decodes it, text is read the way .text reads it (whitespace-only text nodes
+    # shrunk as html.parser shrinks them), and carriage returns are kept, so on well-formed
+    # markup the Staff values equal the bs4 path's. libxml2 does close some tags implicitly
+    # where html.parser doesn't (a <div> inside a <p class="person_data"> ends the <p>), so
+    # malformed pages can come out differently.
+    from bs4.dammit import UnicodeDammit
+    from lxml import etree
+    from lxml import html as lxml_html
+    markup = UnicodeDammit(content, is_html=True).unicode_markup
+    if "\r" in markup:
+        # libxml2 turns CRLF into LF, but keeps a character reference
+        markup = TEXT_CR.sub(lambda match: match.group(1) or "&#13;", markup)
     try:
-        with requests.sessions.Session() as session:
-            # Get the page content using requests
-            page = session.get(kirke.sogndk_url + "praester-medarb")
-            page.raise_for_status()
-            soup = BeautifulSoup(page.content, "html.parser")
+        tree = lxml_html.fromstring(markup)
+    except etree.ParserError:
+        # An empty or element-less page, which has no person_data blocks
+        return []
+    staff = []
+    for person_data in tree.xpath('//*[contains(concat(" ", normalize-space(@class), " "), " person_data ")]'):
+        found = {}
+        for element in person_data.iterdescendants():
+            if not isinstance(element.tag, str):
+                continue
+            for css_class in (element.get("class") or "").split():
+                if css_class in STAFF_CLASSES and css_class not in found:
+                    found[css_class] = element
+        new_staff = Staff()
+        for css_class in STAFF_CLASSES:
+            element = found.get(css_class)
+            setattr(new_staff, css_class, lxml_text(element) if element is not None else "")
+        staff.append(new_staff)
+    return staff
+
+STAFF_PARSERS = {
+    "bs4": parse_staff_bs4,
+    "strainer": parse_staff_strainer,
+    "lxml": parse_staff_lxml,
+}
+DEFAULT_STAFF_PARSER = "strainer"
+
+def parse_staff_html(content, parser=DEFAULT_STAFF_PARSER):
+    return STAFF_PARSERS[parser](content)
+
+def parse_staff_html_timed(content, parser=DEFAULT_STAFF_PARSER):
+    # For the parser processes: METRICS there is a different object, so the timings travel
+    # back with the result. Returns (staff, wall seconds, CPU seconds).
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    staff = parse_staff_html(content, parser)
+    return staff, time.perf_counter() - wall, time.process_time() - cpu
+
+class HostRateLimiter:
+    # Hands out request slots per host so that no more than `rate` requests per second
+    # are started against the same server, no matter how many workers are waiting
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+class AdaptiveRateLimiter(HostRateLimiter):
+    # AIMD rate control per host, fed by the transport after every request attempt. While the
+    # smoothed latency stays under target_latency the rate grows by about `increase` requests/second
+    # every second; a 429 or 503, a failed connection or a smoothed latency over the target cuts it
+    # by `decrease` (at most once per DECREASE_COOLDOWN, so one burst of slow answers counts once).
+    # A Retry-After holds back every worker for that host, and the rate never goes above max_rate.
+    DECREASE_COOLDOWN = 1.0
+    LATENCY_SMOOTHING = 0.3
+    THROTTLE_STATUSES = {429, 503}
+
+    def __init__(self, rate, max_rate=DEFAULT_MAX_RATE, target_latency=DEFAULT_TARGET_LATENCY,
+                 increase=1.0, decrease=0.5, min_rate=MIN_ADAPTIVE_RATE, logger=None):
+        super().__init__(rate)
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.start_rate = min(max_rate, rate) if rate and rate > 0 else max_rate
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.logger = logger or logging.getLogger(__name__)
+        self.rates = {}
+        self.latency = {}
+        self.last_decrease = {}
+
+    def rate(self, host):
+        return self.rates.get(host, self.start_rate)
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + 1.0 / self.rate(host)
+        delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, url, status, latency, retry_after=None):
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            smoothed = self.latency.get(host)
+            smoothed = latency if smoothed is None else smoothed + self.LATENCY_SMOOTHING * (latency - smoothed)
+            self.latency[host] = smoothed
+            rate = self.rate(host)
+            if status is None or status in self.THROTTLE_STATUSES:
+                reason = "HTTP %s" % status if status else "a failed request"
+            elif smoothed > self.target_latency:
+                reason = "latency %.2f s" % smoothed
+            else:
+                reason = None
+
+            if reason is None:
+                # Additive increase: +increase/rate per response is +increase per second at this rate
+                self.rates[host] = min(self.max_rate, rate + self.increase / rate)
+            elif now - self.last_decrease.get(host, float("-inf")) >= self.DECREASE_COOLDOWN:
+                self.rates[host] = max(self.min_rate, rate * self.decrease)
+                self.last_decrease[host] = now
+                self.logger.debug("Slowing down to %.2f requests/second for %s after %s",
+                                  self.rates[host], host, reason)
+            if retry_after:
+                self.next_slot[host] = max(self.next_slot.get(host, now), now + min(retry_after, MAX_RETRY_AFTER))
+
+def download_staff_page(kirke, logger, rate_limiter=None, transport=None):
+    # Download the staff page of the kirke's parish.
+    # Returns (content, http_status, error); content is None if the page could not be retrieved.
+    transport = transport or get_default_transport()
+    url = kirke.sogndk_url + "praester-medarb"
+    if rate_limiter is not None:
+        rate_limiter.wait(url)
+    page = None
+    try:
+        # Get the page content through the shared keep-alive transport
+        page = transport.get(url)
+        page.raise_for_status()
     except requests.exceptions.RequestException as e:
         logger.error("An error occurred while retrieving the web page for Kirke ID %s: %s", kirke.kirke_id, e)
-        return
+        return None, page.status_code if page is not None else None, str(e)
+    return page.content, page.status_code, None
 
+def fetch_staff(kirke, logger, rate_limiter=None, transport=None, parser=DEFAULT_STAFF_PARSER, snapshot=None):
+    # Download and parse the staff page of the kirke's parish.
+    # Returns (staff, http_status, error); staff is None if the page could not be retrieved.
+    # With a snapshot, a page whose person_data markup is unchanged reuses the previous staff.
+    with METRICS.call("staff_download"):
+        content, http_status, error = download_staff_page(kirke, logger, rate_limiter, transport)
+    if content is None:
+        return None, http_status, error
+    staff = None
+    if snapshot is not None:
+        content_hash, staff = snapshot.lookup(kirke.sogndk_url, content)
+    if staff is None:
+        # Extract information about each staff member from the 'person_data' class
+        with METRICS.call("staff_parse"):
+            staff = parse_staff_html(content, parser)
+    if snapshot is not None:
+        snapshot.record(kirke.sogndk_url, content_hash, staff)
+    return staff, http_status, None
+
+def scrape_priests(kirke, logger, rate_limiter=None, transport=None, parser=DEFAULT_STAFF_PARSER):
+    staff, _, _ = fetch_staff(kirke, logger, rate_limiter, transport, parser)
+    if staff is not None:
+        kirke.staff = staff
+
+def group_by_sogndk_url(kirker):
+    # The staff page belongs to the parish, and many parishes have several churches
+    groups = {}
+    for k in kirker:
+        groups.setdefault(k.sogndk_url, []).append(k)
+    return groups
+
+def apply_staff(group, staff, http_status, error, journal):
+    # Attach the staff of one parish page to all its churches and journal the outcome
+    if staff is not None:
+        for k in group:
+            k.staff = staff
+    if journal is not None:
+        journal.record(group, staff, http_status, error)
+
+@contextmanager
+def observing_responses(transport, rate_limiter, logger):
+    # While the block runs, hold every retry of the transport back until the rate limiter gives it
+    # a slot (first attempts wait in download_staff_page), and feed every response to an
+    # AdaptiveRateLimiter, logging the rate each host ended at once the block completes. Other
+    # rate limiters don't observe anything.
+    throttle = rate_limiter.wait
+    observer = getattr(rate_limiter, "observe", None)
+    transport.add_throttle(throttle)
+    if observer is not None:
+        transport.add_observer(observer)
     try:
-        # Find all the elements with class "person_data"
-        staff_list = soup.find_all(class_="person_data")
+        yield
+    finally:
+        transport.remove_throttle(throttle)
+        if observer is not None:
+            transport.remove_observer(observer)
+    if observer is not None:
+        for host, host_rate in rate_limiter.rates.items():
+            logger.info("Finished at %.2f requests/second for %s.", host_rate, host)
 
-        # Extract information about each staff member from the 'person_data' class
-        kirke.staff = []
-        for staff in staff_list:
-            new_staff = Staff()
-            new_staff.navn = get_text_or_empty(staff.find(class_="navn"))
-            new_staff.stilling = get_text_or_empty(staff.find(class_="stilling"))
-            new_staff.adr1 = get_text_or_empty(staff.find(class_="adr1"))
-            new_staff.postnr_by = get_text_or_empty(staff.find(class_="postnr_by"))
-            new_staff.email = get_text_or_empty(staff.find(class_="email"))
-            new_staff.tlf = get_text_or_empty(staff.find(class_="tlf"))
-            kirke.staff.append(new_staff)
+@METRICS.timed("staff_scrape")
+def scrape_all_priests(kirker, logger, concurrency=DEFAULT_CONCURRENCY, rate=DEFAULT_RATE, transport=None,
+                       parser=DEFAULT_STAFF_PARSER, journal=None, parse_workers=DEFAULT_PARSE_WORKERS,
+                       rate_limiter=None, snapshot=None):
+    # Scrape the staff pages with a pool of workers. The rate limiter is shared by all workers,
+    # so the total run time is bounded by the politeness budget rather than by the latency of each page.
+    # Without a rate_limiter a HostRateLimiter at the fixed `rate` is used; an AdaptiveRateLimiter
+    # is fed every response of the transport while the scrape runs.
+    # Each parish page is fetched once and the staff list is attached to every church in the parish.
+    # With a journal, every finished page is committed as soon as it completes.
+    # With a snapshot, pages whose staff markup hasn't changed since the last run are not parsed again.
+    transport = transport or get_default_transport()
+    rate_limiter = rate_limiter or HostRateLimiter(rate)
+    groups = group_by_sogndk_url(kirker)
+    with observing_responses(transport, rate_limiter, logger):
+        if parse_workers > 0:
+            scrape_pipelined(groups, len(kirker), logger, concurrency, rate_limiter, transport, parser, journal,
+                             parse_workers, snapshot)
+        else:
+            scrape_threaded(groups, len(kirker), logger, concurrency, rate_limiter, transport, parser, journal, snapshot)
+    logger.info("Fetched %s staff pages for %s churches (%s requests saved).",
+                len(groups), len(kirker), len(kirker) - len(groups))
+    if snapshot is not None:
+        logger.info("%s staff pages unchanged since the last snapshot, not parsed again.", snapshot.reused)
 
-    except requests.exceptions.RequestException as e:
-        logger.error("An error occurred while scraping the staff data for Kirke ID %s: %s", kirke.kirke_id, e)
+def scrape_threaded(groups, total, logger, concurrency, rate_limiter, transport, parser, journal, snapshot=None):
+    # Each worker thread downloads and parses its page
+    from tqdm import tqdm
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = {executor.submit(fetch_staff, group[0], logger, rate_limiter, transport, parser, snapshot): group
+                   for group in groups.values()}
+        try:
+            with tqdm(total=total, desc="Scraping Priests Data") as progress:
+                for future in as_completed(futures):
+                    group = futures[future]
+                    try:
+                        staff, http_status, error = future.result()
+                    except Exception as e:
+                        logger.error("Unexpected error while scraping staff data for Kirke ID %s: %s", group[0].kirke_id, e)
+                        staff, http_status, error = None, None, str(e)
+                    apply_staff(group, staff, http_status, error, journal)
+                    progress.update(len(group))
+        except KeyboardInterrupt:
+            # Don't start the queued pages; only the ones already in flight are waited for
+            executor.shutdown(wait=False, cancel_futures=True)
+            if journal is not None:
+                logger.warning("Scrape interrupted. Run again with --resume to continue from %s.", journal.path)
+            raise
+
+def scrape_pipelined(groups, total, logger, concurrency, rate_limiter, transport, parser, journal, parse_workers,
+                     snapshot=None):
+    # Producer/consumer pipeline: `concurrency` download threads put raw pages on a bounded queue,
+    # and a process pool turns them into Staff records, so parsing is not limited by the GIL.
+    # The queue and the cap on pages being parsed keep memory bounded when parsing falls behind:
+    # the downloaders simply block on a full queue.
+    from tqdm import tqdm
+    pages = queue.Queue(maxsize=2 * parse_workers)
+    pending = iter(list(groups.values()))
+    pending_lock = threading.Lock()
+    stop = threading.Event()
+    done = object()
+
+    def download_worker():
+        try:
+            while not stop.is_set():
+                with pending_lock:
+                    group = next(pending, None)
+                if group is None:
+                    break
+                try:
+                    with METRICS.call("staff_download"):
+                        content, http_status, error = download_staff_page(group[0], logger, rate_limiter, transport)
+                except Exception as e:
+                    logger.error("Unexpected error while downloading staff data for Kirke ID %s: %s", group[0].kirke_id, e)
+                    content, http_status, error = None, None, str(e)
+                # Hash here rather than in the main loop, which has to keep the parsers fed
+                content_hash, staff = None, None
+                if snapshot is not None and content is not None:
+                    content_hash, staff = snapshot.lookup(group[0].sogndk_url, content)
+                pages.put((group, content, http_status, error, content_hash, staff))
+        finally:
+            pages.put(done)
+
+    max_in_flight = 2 * parse_workers
+    in_flight = {}
+
+    # The parsers are spawned rather than forked: the pool starts its processes on demand, by
+    # which time the download threads may hold locks (logging, the connection pool) that a forked
+    # child would inherit locked. Spawning is also what the frozen Windows build does.
+    with ProcessPoolExecutor(max_workers=parse_workers, mp_context=multiprocessing.get_context("spawn")) as pool, \
+            tqdm(total=total, desc="Scraping Priests Data") as progress:
+        downloaders = [threading.Thread(target=download_worker, daemon=True) for _ in range(max(1, concurrency))]
+        for thread in downloaders:
+            thread.start()
+        active_downloaders = len(downloaders)
+        try:
+            while active_downloaders or in_flight:
+                for future in [f for f in in_flight if f.done()]:
+                    group, http_status, content_hash = in_flight.pop(future)
+                    try:
+                        staff, wall, cpu = future.result()
+                        METRICS.observe_stage("staff_parse", wall, cpu)
+                        if snapshot is not None:
+                            snapshot.record(group[0].sogndk_url, content_hash, staff)
+                        apply_staff(group, staff, http_status, None, journal)
+                    except Exception as e:
+                        logger.error("An error occurred while parsing the staff data for Kirke ID %s: %s", group[0].kirke_id, e)
+                        apply_staff(group, None, http_status, str(e), journal)
+                    progress.update(len(group))
+
+                if active_downloaders and len(in_flight) < max_in_flight:
+                    try:
+                        item = pages.get(timeout=0.05 if in_flight else None)
+                    except queue.Empty:
+                        continue
+                    if item is done:
+                        active_downloaders -= 1
+                        continue
+                    group, content, http_status, error, content_hash, staff = item
+                    if content is None:
+                        apply_staff(group, None, http_status, error, journal)
+                        progress.update(len(group))
+                    elif staff is not None:
+                        # Unchanged since the last snapshot
+                        snapshot.record(group[0].sogndk_url, content_hash, staff)
+                        apply_staff(group, staff, http_status, None, journal)
+                        progress.update(len(group))
+                    else:
+                        future = pool.submit(parse_staff_html_timed, content, parser)
+                        in_flight[future] = (group, http_status, content_hash)
+                elif in_flight:
+                    wait(in_flight, return_when=FIRST_COMPLETED)
+        except KeyboardInterrupt:
+            stop.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            if journal is not None:
+                logger.warning("Scrape interrupted. Run again with --resume to continue from %s.", journal.path)
+            raise
+
+def stream_staff(kirker, logger, concurrency=DEFAULT_CONCURRENCY, rate_limiter=None, transport=None,
+                 parser=DEFAULT_STAFF_PARSER, journal=None, resume=False, window=DEFAULT_WINDOW):
+    # Generator version of scrape_all_priests for streaming runs: takes any iterable of Kirke and
+    # yields them in the same order with their staff attached, with at most `window` churches
+    # waiting for their page. A page is fetched once for all churches of its parish that are
+    # close together in the feed (the feed lists a parish's churches next to each other).
+    # With resume=True, churches the journal already has are not scraped again.
+    from tqdm import tqdm
+    transport = transport or get_default_transport()
+    rate_limiter = rate_limiter or HostRateLimiter(DEFAULT_RATE)
+    recent_pages = OrderedDict()
+    waiting = deque()
+
+    def finish(kirke, future):
+        if future is None:
+            return kirke
+        try:
+            staff, http_status, error = future.result()
+        except Exception as e:
+            logger.error("Unexpected error while scraping staff data for Kirke ID %s: %s", kirke.kirke_id, e)
+            staff, http_status, error = None, None, str(e)
+        apply_staff([kirke], staff, http_status, error, journal)
+        return kirke
+
+    with observing_responses(transport, rate_limiter, logger), \
+            ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor, \
+            tqdm(desc="Scraping Priests Data", unit=" churches") as progress:
+        try:
+            for kirke in kirker:
+                staff = journal.staff_of(kirke.kirke_id) if resume and journal is not None else None
+                if staff is not None:
+                    kirke.staff = staff
+                    waiting.append((kirke, None))
+                else:
+                    future = recent_pages.get(kirke.sogndk_url)
+                    if future is None:
+                        future = executor.submit(fetch_staff, kirke, logger, rate_limiter, transport, parser)
+                        recent_pages[kirke.sogndk_url] = future
+                        if len(recent_pages) > window:
+                            recent_pages.popitem(last=False)
+                    waiting.append((kirke, future))
+                # Hand on every finished church at the head of the line; block once the window is full
+                while waiting and (len(waiting) >= window or waiting[0][1] is None or waiting[0][1].done()):
+                    yield finish(*waiting.popleft())
+                    progress.update(1)
+            while waiting:
+                yield finish(*waiting.popleft())
+                progress.update(1)
+        except (KeyboardInterrupt, GeneratorExit):
+            executor.shutdown(wait=False, cancel_futures=True)
+            if journal is not None:
+                logger.warning("Scrape interrupted. Run again with --resume to continue from %s.", journal.path)
+            raise
+
+def split_ccli_nums(ccli_num):
+    # 'CCLI Num' has sogne_id values. This cell can have multiple sogne_ids separated by ';'
+    if isinstance(ccli_num, float) and ccli_num.is_integer():
+        ccli_num = int(ccli_num)
+    return str(ccli_num).split(';')
+
+def build_sogne_index(kirker, substring=False):
+    # Map sogne_id (as text) to its churches. With substring=True every substring of the id is
+    # indexed too, including the empty string, so a lookup matches exactly the churches for
+    # which `num in str(kirke.sogne_id)` holds.
+    index = {}
+    for kirke in kirker:
+        for key in sogne_keys(kirke.sogne_id, substring):
+            index.setdefault(key, []).append(kirke)
+    return index
+
+@METRICS.timed("import_status")
+def import_account_status(df, kirker, logger, substring=False):
+    # Apply the 'Account Status' of each row to the churches whose sogne_id is listed in its
+    # 'CCLI Num' cell. Rows are applied in order, so a later row wins like it always has.
+    # By default the numbers must equal the sogne_id; substring=True keeps the old
+    # "number contained in sogne_id" matching.
+    import pandas as pd
+    index = build_sogne_index(kirker, substring)
+    matched = 0
+    unmatched = 0
+    for ccli_num, account_status in zip(df['CCLI Num'], df['Account Status']):
+        if pd.isna(ccli_num):
+            continue
+        for num in split_ccli_nums(ccli_num):
+            if not substring:
+                num = num.strip()
+                if not num:
+                    continue
+            matching_kirker = index.get(num)
+            if not matching_kirker:
+                unmatched += 1
+                continue
+            for kirke in matching_kirker:
+                kirke.account_status = clean_status(account_status)
+            matched += 1
+    logger.info("%s CCLI numbers matched a parish, %s did not.", matched, unmatched)
+
+def build_status_index(df, substring=False):
+    # The other way round from build_sogne_index, for streaming runs where the churches aren't all
+    # in memory: map each CCLI number to (row, Account Status), a later row replacing an earlier one
+    import pandas as pd
+    index = {}
+    for row, (ccli_num, account_status) in enumerate(zip(df['CCLI Num'], df['Account Status'])):
+        if pd.isna(ccli_num):
+            continue
+        for num in split_ccli_nums(ccli_num):
+            if not substring:
+                num = num.strip()
+                if not num:
+                    continue
+            index[num] = (row, clean_status(account_status))
+    return index
+
+@METRICS.timed("import_status")
+def import_account_status_into_store(df, store, logger, substring=False):
+    # Option 2 against the --store: the CCLI numbers are joined against the stored churches in SQLite
+    matched, unmatched = store.apply_status_index(build_status_index(df, substring), substring)
+    logger.info("%s CCLI numbers matched a parish in %s, %s did not.", matched, store.path, unmatched)
 
-def save_to_excel(kirker, logger):
+def stream_account_status(kirker, index, substring=False):
+    # Generator: set the Account Status of each Kirke from a build_status_index index and pass it
+    # on. Gives the same result as import_account_status: the last row whose number matches wins.
+    for kirke in kirker:
+        matches = [index[key] for key in sogne_keys(kirke.sogne_id, substring) if key in index]
+        match = max(matches) if matches else None
+        if match is not None:
+            kirke.account_status = match[1]
+        yield kirke
+
+def iter_export_rows(kirker):
+    # One row per staff member, produced lazily so the writers can stream them to disk
+    for k in kirker:
+        kirke_values = tuple(getattr(k, field) for _, field in EXPORT_KEY_COLUMNS) + \
+            tuple(getattr(k, field) for field in KIRKE_EXPORT_FIELDS)
+        for s in k.staff:
+            yield kirke_values + tuple(getattr(s, field) for field in STAFF_FIELDS)
+
+@METRICS.timed("export")
+def export_kirker(kirker, file_path, logger, fmt=None, changes=None, persons=False):
+    # changes, the rows of an incremental scrape's change report, are written as a 'Changes'
+    # sheet (a 'Changes' table for sqlite, a .changes file next to a csv or parquet export)
+    # kirker may also be a generator (streaming runs); it is then written row by row in every format
+    # persons=True writes the 'Kirker', 'Persons' and 'Person Kirker' sheets of persons.py instead
+    # of 'Kirker and Staff', with the staff fields normalised and each person listed once
+    fmt = fmt or format_from_path(file_path)
+    if persons:
+        sheets = person_sheets(KirkeTable.from_kirker(kirker), logger)
+        if changes is not None:
+            sheets.append(("Changes", CHANGE_COLUMNS, changes))
+        counts = write_sheets(sheets, file_path, fmt)
+        logger.info("%s churches, %s persons and %s person links saved to %s (%s)",
+                    counts[0], counts[1], counts[2], file_path, fmt)
+    elif fmt == "parquet" and isinstance(kirker, list):
+        # Parquet is columnar, so hand pyarrow whole columns instead of rows
+        count = write_table(KirkeTable.from_kirker(kirker).to_arrow(), file_path, fmt)
+        if changes is not None:
+            write_rows(changes, CHANGE_COLUMNS, sheet_path(file_path, "Changes"), fmt, "Changes")
+    elif changes is not None:
+        count, _ = write_sheets([("Kirker and Staff", EXPORT_COLUMNS, iter_export_rows(kirker)),
+                                 ("Changes", CHANGE_COLUMNS, changes)], file_path, fmt)
+    else:
+        count = write_rows(iter_export_rows(kirker), EXPORT_COLUMNS, file_path, fmt)
+    if not persons:
+        logger.info("%s rows saved to %s (%s)", count, file_path, fmt)
+    if changes is not None:
+        logger.info("%s changes saved with the export.", len(changes))
+
+@METRICS.timed("load_export")
+def load_kirker_from_export(file_path, fmt=None):
+    # Rebuild Kirke and Staff records from an earlier 'Kirker and Staff' export
+    import pandas as pd
+    fmt = fmt or format_from_path(file_path)
+    if fmt == "xlsx":
+        df = pd.read_excel(file_path)
+    elif fmt == "csv":
+        df = pd.read_csv(file_path)
+    elif fmt == "parquet":
+        df = pd.read_parquet(file_path)
+    else:
+        connection = sqlite3.connect(file_path)
+        try:
+            df = pd.read_sql_query("SELECT * FROM kirker_and_staff", connection)
+        finally:
+            connection.close()
+    # The SQLite export keeps 'Kirke_id' rather than 'kirke_id', so look columns up case-insensitively
+    columns = {column.lower(): column for column in reversed(df.columns)}
+
+    def value(row, field):
+        column = columns.get(field.lower())
+        if column is None:
+            return None
+        v = row[column]
+        return None if pd.isna(v) else v
+
+    kirker = {}
+    for _, row in df.iterrows():
+        kirke_id = int(value(row, "kirke_id"))
+        kirke = kirker.get(kirke_id)
+        if kirke is None:
+            kirke = Kirke()
+            for field in KIRKE_FIELDS:
+                setattr(kirke, field, value(row, field))
+            for field in ("kirke_id", "kirke_postnr", "sogne_id", "provsti_id"):
+                if getattr(kirke, field) is not None:
+                    setattr(kirke, field, int(getattr(kirke, field)))
+            kirke.account_status = clean_status(value(row, "account_status"))
+            kirker[kirke_id] = kirke
+        new_staff = Staff()
+        for field in STAFF_FIELDS:
+            v = value(row, field)
+            setattr(new_staff, field, "" if v is None else str(v))
+        kirke.staff.append(new_staff)
+    return list(kirker.values())
+
+@METRICS.timed("read_status_file")
+def read_status_file(file_path, logger):
+    # Read the CCLI 'Account Status' spreadsheet. Returns None if it can't be read.
+    import pandas as pd
+    if not os.path.isfile(file_path):
+        logger.warning("File not found. Please check this path exists: %s", file_path)
+        return None
+    try:
+        df = pd.read_excel(file_path)
+    except Exception as e:
+        logger.error("Error reading Excel file: %s", str(e))
+        return None
+    logger.info("%s rows loaded from %s", len(df.index), file_path)
+    return df
+
+def save_to_excel(kirker, logger, fmt=None, changes=None, persons=False):
     # Check if user wants to save data
     save_file_choice = input("Do you want to save the data to an Excel file? (y/n) ")
     while save_file_choice not in ["y", "n"]:
@@ -123,136 +791,746 @@ def save_to_excel(kirker, logger):
         return
 
     # Open file dialog to select file path
+    from tkinter import filedialog, Tk
     root = Tk()
     root.withdraw()
 
-    file_path = filedialog.asksaveasfilename(defaultextension=".xlsx")
+    extension = "." + (fmt or "xlsx")
+    file_path = filedialog.asksaveasfilename(defaultextension=extension,
+                                             filetypes=[(f.upper() + " files", "*." + f) for f in EXPORT_FORMATS])
     if not file_path:
         logger.warning("No file selected. Data not saved.")
         return
 
-    # Create a new Excel workbook
-    workbook = pd.ExcelWriter(file_path, engine='openpyxl')
+    # Stream the Kirker and Staff rows to the file
+    export_kirker(kirker, file_path, logger, fmt, changes, persons)
+
+def open_cache(options, logger):
+    # The response cache is opt-in: --cache PATH [--cache-max-age SECONDS] [--cache-size MB]
+    if not options.cache:
+        return None
+    max_size = int(options.cache_size * 1024 * 1024)
+    logger.debug("Using response cache %s (max age %s s, max size %s bytes)", options.cache, options.cache_max_age, max_size)
+    return ResponseCache(options.cache, max_size=max_size, max_age=options.cache_max_age)
+
+def open_transport(options, logger):
+    # One pooled transport for the feed and every staff page, sized to the scrape concurrency
+    return create_transport(options.transport, pool_size=max(1, options.concurrency), logger=logger,
+                            cache=open_cache(options, logger))
+
+def scrape_feed(kirker, options, logger):
+    # Read the church feed into kirker. Returns the transport to reuse for the staff pages.
+    transport = open_transport(options, logger)
+    with METRICS.stage("feed"):
+        kirker.extend(stream_kirke_xml(options.feed_url, logger, transport))
+    if kirker:
+        logger.info("%s churches found.", len(kirker))
+        kirker[:] = select_region(kirker, options, logger)
+    else:
+        logger.error("Unable to retrieve data from the web. Please try again.")
+    return transport
+
+def region_of(options):
+    # --bbox and --within restrict a run to the churches inside them (both: inside both)
+    if not options.bbox and not options.within:
+        return None
+    from spatial import Region
+    return Region(options.bbox, options.within)
+
+def select_region(kirker, options, logger):
+    region = region_of(options)
+    if region is None:
+        return kirker
+    selected = region.select(kirker)
+    if selected:
+        logger.info("%s of %s churches are inside %s.", len(selected), len(kirker), region)
+    else:
+        logger.warning("None of the %s churches are inside %s.", len(kirker), region)
+    return selected
+
+def make_rate_limiter(options, logger):
+    if options.adaptive_rate:
+        rate_limiter = AdaptiveRateLimiter(options.rate, max_rate=options.max_rate,
+                                           target_latency=options.target_latency, logger=logger)
+        logger.debug("Scraping with %s workers, adapting from %s up to %s requests/second per host",
+                     options.concurrency, rate_limiter.start_rate, options.max_rate)
+        return rate_limiter
+    logger.debug("Scraping with %s workers at %s requests/second per host", options.concurrency, options.rate)
+    return HostRateLimiter(options.rate)
+
+def open_snapshot(options, logger):
+    # Incremental scraping is opt-in: --incremental [--snapshot PATH]
+    if not options.incremental:
+        return None
+    logger.debug("Comparing with the staff snapshot in %s", options.snapshot)
+    return StaffSnapshot(options.snapshot)
+
+def scrape_staff(kirker, options, transport, logger, snapshot=None):
+    # Finished churches are journalled; --resume picks up where an interrupted run stopped
+    journal = ScrapeJournal(options.journal)
+    try:
+        if options.resume:
+            to_scrape = resume_from_journal(kirker, journal, logger)
+            if snapshot is not None:
+                remaining = {id(k) for k in to_scrape}
+                for k in kirker:
+                    if id(k) not in remaining:
+                        snapshot.record(k.sogndk_url, None, k.staff)
+        else:
+            journal.reset()
+            to_scrape = kirker
+        scrape_all_priests(to_scrape, logger, concurrency=options.concurrency, rate=options.rate, transport=transport,
+                           parser=options.parser, journal=journal, parse_workers=options.parse_workers,
+                           rate_limiter=make_rate_limiter(options, logger), snapshot=snapshot)
+    finally:
+        journal.close()
+
+def apply_status_file(kirker, options, logger):
+    df = read_status_file(options.status_file, logger)
+    if df is None:
+        return False
+    # Update the account status of the Kirke objects based on the data in the DataFrame
+    import_account_status(df, kirker, logger, substring=options.substring_match)
+    return True
+
+def command_scrape_stream(options, logger):
+    # scrape --stream: the churches flow from the feed through the staff scrape and the status
+    # file into the export as generators, so memory use doesn't grow with the number of churches
+    transport = open_transport(options, logger)
+    journal = None
+    store = None
+    try:
+        feed = stream_kirke_xml(options.feed_url, logger, transport)
+        region = region_of(options)
+        if region is not None:
+            feed = (kirke for kirke in feed if region.contains(kirke))
+        first = next(feed, None)
+        if first is None:
+            if region is None:
+                logger.error("Unable to retrieve data from the web. Please try again.")
+            else:
+                logger.error("No churches inside %s, or the feed could not be read.", region)
+            return 1
+        kirker = itertools.chain((first,), feed)
+        if not options.no_staff:
+            journal = ScrapeJournal(options.journal)
+            if not options.resume:
+                journal.reset()
+            kirker = stream_staff(kirker, logger, concurrency=options.concurrency,
+                                  rate_limiter=make_rate_limiter(options, logger), transport=transport,
+                                  parser=options.parser, journal=journal, resume=options.resume, window=options.window)
+        if options.status_file:
+            df = read_status_file(options.status_file, logger)
+            if df is None:
+                return 1
+            kirker = stream_account_status(kirker, build_status_index(df, options.substring_match),
+                                           options.substring_match)
+        if options.store:
+            store = KirkeStore(options.store)
+            kirker = store.saving(kirker, staff=not options.no_staff)
+        # Everything upstream runs as the export pulls rows
+        export_kirker(kirker, options.output, logger, options.format)
+    finally:
+        if store is not None:
+            store.close()
+        if journal is not None:
+            journal.close()
+        transport.close()
+    return 0
+
+def command_scrape(options, logger):
+    if options.stream:
+        return command_scrape_stream(options, logger)
+    kirker = []
+    transport = scrape_feed(kirker, options, logger)
+    if not kirker:
+        return 1
+    snapshot = None if options.no_staff else open_snapshot(options, logger)
+    try:
+        changes = None
+        if not options.no_staff:
+            scrape_staff(kirker, options, transport, logger, snapshot)
+        if snapshot is not None:
+            changes = snapshot.changes(kirker, logger)
+        if options.status_file and not apply_status_file(kirker, options, logger):
+            return 1
+        export_kirker(kirker, options.output, logger, options.format, changes, options.persons)
+        # Only a run that got as far as the export becomes the new baseline
+        if snapshot is not None:
+            snapshot.save()
+        if options.store:
+            save_to_store(kirker, options, logger, staff=not options.no_staff)
+    finally:
+        if snapshot is not None:
+            snapshot.close()
+    return 0
+
+def save_to_store(kirker, options, logger, staff=True):
+    store = KirkeStore(options.store)
+    try:
+        count = store.save(kirker, staff)
+        logger.info("%s churches saved to the store %s (%s in total).", count, options.store, len(store))
+    finally:
+        store.close()
+
+def open_existing_store(options, logger):
+    # The store for reading, or None (after logging why) if --store doesn't exist yet
+    if not os.path.isfile(options.store):
+        logger.error("No store at %s. Run a scrape with --store first.", options.store)
+        return None
+    return KirkeStore(options.store)
+
+def command_import_status(options, logger):
+    if not options.input:
+        # Join the status file against the --store, and export the stored churches
+        df = read_status_file(options.status_file, logger)
+        if df is None:
+            return 1
+        store = open_existing_store(options, logger)
+        if store is None:
+            return 1
+        try:
+            import_account_status_into_store(df, store, logger, substring=options.substring_match)
+            kirker = store.kirker()
+        finally:
+            store.close()
+        export_kirker(kirker, options.output, logger, options.format, persons=options.persons)
+        return 0
+    kirker = load_kirker_from_export(options.input)
+    logger.info("%s churches loaded from %s", len(kirker), options.input)
+    if not apply_status_file(kirker, options, logger):
+        return 1
+    export_kirker(kirker, options.output, logger, options.format, persons=options.persons)
+    return 0
 
-    # Create worksheet for Kirker and Staff data
-    kirker_list = []
+def command_export(options, logger):
+    if options.input:
+        kirker = load_kirker_from_export(options.input)
+        logger.info("%s churches loaded from %s", len(kirker), options.input)
+    else:
+        # Export whatever the journal holds, using the feed for the church details
+        kirker = []
+        scrape_feed(kirker, options, logger)
+        if not kirker:
+            return 1
+        journal = ScrapeJournal(options.journal)
+        try:
+            resume_from_journal(kirker, journal, logger)
+        finally:
+            journal.close()
+    export_kirker(kirker, options.output, logger, options.format, persons=options.persons)
+    return 0
+
+def print_kirker(kirker):
     for k in kirker:
+        line = "%s %s | sogn %s %s | provsti %s %s" % (k.kirke_id, k.kirke_navn, k.sogne_id, k.sogne_navn,
+                                                      k.provsti_id, k.provsti_navn)
+        if k.account_status:
+            line += " | %s" % k.account_status
+        print(line)
         for s in k.staff:
-            kirke_dict = {
-                'Account Status': k.account_status,
-                'Sogne_id': k.sogne_id,
-                'Kirke_id': k.kirke_id,
-                'Kirke_navn': k.kirke_navn
-            }
-            kirke_dict.update(k.__dict__)
-            kirke_dict.update(s.__dict__)
-            kirker_list.append(kirke_dict)
-
-    kirker_df = pd.DataFrame(kirker_list)
-    kirker_df.drop(['staff'], axis=1, inplace=True)
-    kirker_df.to_excel(workbook, index=False, sheet_name='Kirker and Staff')
-
-    # Save workbook to file path
-    workbook.save()
-    logger.info("Data saved to %s" % file_path)
-
-def main(kirker):
-    # Create logger and formatter
-    handler = colorlog.StreamHandler()
-    handler.setFormatter(colorlog.ColoredFormatter(
-        "%(log_color)s%(levelname)s:%(message)s",
-        log_colors={
-            'DEBUG': 'cyan',
-            'INFO': 'white',
-            'WARNING': 'yellow',
-            'ERROR': 'red',
-            'CRITICAL': 'red,bg_white',
-        }))
-    logger = colorlog.getLogger()
-    logger.setLevel(logging.DEBUG)
+            print("    %s: %s" % (s.stilling, " ".join(value for value in (s.navn, s.email, s.tlf) if value)))
+
+def command_query(options, logger):
+    # Look churches up in the --store; print them, or export them with --output
+    store = open_existing_store(options, logger)
+    if store is None:
+        return 1
+    try:
+        started = time.perf_counter()
+        kirker = store.kirker(kirke_ids=options.kirke_id, sogne_id=options.sogne_id,
+                              provsti_id=options.provsti_id, email=options.email)
+        logger.info("%s churches found in %s (%.1f ms).", len(kirker), options.store,
+                    (time.perf_counter() - started) * 1000)
+    finally:
+        store.close()
+    if options.output:
+        export_kirker(kirker, options.output, logger, options.format, persons=options.persons)
+    else:
+        print_kirker(kirker)
+    return 0
+
+def command_shard_plan(options, logger):
+    # Read the feed once and put its churches on the work queue in shards
+    kirker = []
+    scrape_feed(kirker, options, logger).close()
+    if not kirker:
+        return 1
+    shard_queue = ShardQueue(options.queue)
+    try:
+        sizes = shard_queue.plan(kirker, options.shard_by, options.shards)
+    finally:
+        shard_queue.close()
+    logger.info("%s churches queued in %s shards by %s in %s (largest shard: %s churches).",
+                len(kirker), len(sizes), options.shard_by, options.queue, max(sizes.values()))
+    return 0
+
+def scrape_shard(shard_queue, shard_id, kirker, options, transport, logger):
+    # Scrape one shard and export it next to the queue. Returns an error message, or None on success.
+    journal = ScrapeJournal(shard_queue.journal_path(shard_id))
+    try:
+        # A retried shard only scrapes what its earlier attempts didn't finish
+        to_scrape = resume_from_journal(kirker, journal, logger)
+        scrape_all_priests(to_scrape, logger, concurrency=options.concurrency, rate=options.rate, transport=transport,
+                           parser=options.parser, journal=journal, parse_workers=options.parse_workers,
+                           rate_limiter=make_rate_limiter(options, logger))
+        failed = journal.failed_ids()
+    finally:
+        journal.close()
+    if failed:
+        return "%s of %s churches could not be scraped" % (len(failed), len(kirker))
+    export_kirker(kirker, shard_queue.output_path(shard_id), logger, "sqlite")
+    return None
+
+def run_shard_worker(options, logger):
+    # Claim and scrape shards until the queue is empty (or --max-shards are done)
+    worker = worker_name()
+    shard_queue = ShardQueue(options.queue, lease=options.lease)
+    transport = open_transport(options, logger)
+    finished = 0
+    try:
+        while options.max_shards is None or finished < options.max_shards:
+            claimed = shard_queue.claim(worker, options.retry_failed)
+            if claimed is None:
+                break
+            shard_id, kirker = claimed
+            logger.info("%s: scraping shard %s (%s churches)", worker, shard_id, len(kirker))
+            try:
+                error = scrape_shard(shard_queue, shard_id, kirker, options, transport, logger)
+            except KeyboardInterrupt:
+                shard_queue.release(shard_id, worker)
+                raise
+            except Exception as e:
+                error = str(e)
+            if error:
+                logger.error("%s: shard %s failed: %s", worker, shard_id, error)
+            shard_queue.finish(shard_id, worker, error)
+            finished += 1
+    finally:
+        transport.close()
+        shard_queue.close()
+    logger.info("%s: %s shards scraped, no more work.", worker, finished)
+
+def shard_worker_process(options):
+    # Entry point of the --processes worker processes. A forked process already has the parent's log handler.
+    logger = logging.getLogger()
+    if not logger.handlers:
+        logger = setup_logger(False, options.verbose)
+    try:
+        run_shard_worker(options, logger)
+    except KeyboardInterrupt:
+        pass
+
+def command_shard_work(options, logger):
+    # --rate and --concurrency apply to each worker process, not to all of them together
+    if options.processes <= 1:
+        run_shard_worker(options, logger)
+        return 0
+    processes = [multiprocessing.Process(target=shard_worker_process, args=(options,))
+                 for _ in range(options.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return 0 if all(process.exitcode == 0 for process in processes) else 1
+
+def command_shard_merge(options, logger):
+    # Combine the shard outputs into one export, in the order of the feed
+    shard_queue = ShardQueue(options.queue)
+    try:
+        status = shard_queue.status()
+        outputs = shard_queue.finished_outputs()
+        order = shard_queue.feed_order()
+    finally:
+        shard_queue.close()
+    unfinished = sum(count for state, count in status.items() if state != "done")
+    if unfinished:
+        if not options.allow_partial:
+            logger.error("%s of %s shards are not done (%s). Use --allow-partial to merge anyway.",
+                         unfinished, sum(status.values()), ", ".join("%s %s" % item for item in sorted(status.items())))
+            return 1
+        logger.warning("Merging without %s unfinished shards.", unfinished)
+    kirker = []
+    for path in outputs:
+        kirker.extend(load_kirker_from_export(path, "sqlite"))
+    kirker.sort(key=lambda k: order.get(k.kirke_id, len(order)))
+    logger.info("%s churches merged from %s shards.", len(kirker), len(outputs))
+    if options.status_file and not apply_status_file(kirker, options, logger):
+        return 1
+    export_kirker(kirker, options.output, logger, options.format, persons=options.persons)
+    return 0
+
+def read_points(options, logger):
+    # (name, lat, lng) of every --point and of every row of the --points CSV. Returns None if the CSV can't be used.
+    points = [("%s,%s" % point, point[0], point[1]) for point in options.point or ()]
+    if options.points:
+        import pandas as pd
+        try:
+            df = pd.read_csv(options.points)
+        except Exception as e:
+            logger.error("Error reading %s: %s", options.points, e)
+            return None
+        columns = {column.lower(): column for column in df.columns}
+        if "lat" not in columns or "lng" not in columns:
+            logger.error("%s needs 'lat' and 'lng' columns.", options.points)
+            return None
+        df = df.dropna(subset=[columns["lat"], columns["lng"]])
+        lats = df[columns["lat"]].astype(float)
+        lngs = df[columns["lng"]].astype(float)
+        if "name" in columns:
+            names = df[columns["name"]].astype(str)
+        else:
+            names = lats.astype(str) + "," + lngs.astype(str)
+        points.extend(zip(names, lats, lngs))
+    return points
+
+def command_nearby(options, logger):
+    # The -k nearest churches to each point, or every church within --radius km of it
+    from spatial import ChurchIndex
+    points = read_points(options, logger)
+    if points is None:
+        return 1
+    if options.input:
+        kirker = select_region(load_kirker_from_export(options.input), options, logger)
+    else:
+        kirker = []
+        scrape_feed(kirker, options, logger).close()
+    if not kirker:
+        return 1
+    index = ChurchIndex(kirker)
+    logger.info("%s churches with coordinates indexed.", len(index))
+
+    def rows():
+        for name, lat, lng in points:
+            if options.radius is not None:
+                matches = index.within(lat, lng, options.radius)
+            else:
+                matches = index.nearest(lat, lng, options.k)
+            for rank, (kirke, distance) in enumerate(matches, 1):
+                yield (name, lat, lng, rank, round(distance, 3)) + tuple(getattr(kirke, field) for field in KIRKE_FIELDS)
+
+    count = write_rows(rows(), NEARBY_COLUMNS, options.output, options.format, "Nearby")
+    logger.info("%s matches for %s points saved to %s", count, len(points), options.output)
+    return 0
+
+def coordinates(names):
+    # argparse type for comma-separated numbers, e.g. coordinates(("LAT", "LNG")) for '55.68,12.57'
+    def parse(text):
+        try:
+            values = tuple(float(value) for value in text.split(","))
+        except ValueError:
+            values = ()
+        if len(values) != len(names):
+            raise argparse.ArgumentTypeError("expected %s, got %r" % (",".join(names), text))
+        return values
+    return parse
+
+def add_region_arguments(parser):
+    group = parser.add_argument_group("region")
+    group.add_argument("--bbox", type=coordinates(("SOUTH", "WEST", "NORTH", "EAST")), metavar="SOUTH,WEST,NORTH,EAST",
+                       help="only use the churches inside this latitude/longitude box")
+    group.add_argument("--within", type=coordinates(("LAT", "LNG", "KM")), metavar="LAT,LNG,KM",
+                       help="only use the churches within KM kilometres of this point")
+
+def add_scrape_arguments(parser):
+    group = parser.add_argument_group("scraping")
+    group.add_argument("--feed-url", default=FEED_URL, help="church feed to read (default: %(default)s)")
+    group.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                       help="number of staff pages downloaded at once (default: %(default)s)")
+    group.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                       help="maximum requests per second per host, 0 for no limit (default: %(default)s); "
+                            "with --adaptive-rate the starting rate")
+    group.add_argument("--adaptive-rate", action="store_true",
+                       help="speed up while the server answers quickly, slow down on 429/503 or slow answers")
+    group.add_argument("--max-rate", type=float, default=DEFAULT_MAX_RATE,
+                       help="hard ceiling for --adaptive-rate in requests per second per host (default: %(default)s)")
+    group.add_argument("--target-latency", type=float, default=DEFAULT_TARGET_LATENCY,
+                       help="response time in seconds above which --adaptive-rate slows down (default: %(default)s)")
+    group.add_argument("--parser", choices=sorted(STAFF_PARSERS), default=DEFAULT_STAFF_PARSER,
+                       help="staff page extraction backend: all three give identical results on well-formed pages, "
+                            "lxml is the fastest but can read malformed markup differently (default: %(default)s)")
+    group.add_argument("--parse-workers", type=int, default=DEFAULT_PARSE_WORKERS,
+                       help="parse staff pages in this many processes, 0 to parse in the download threads")
+    group.add_argument("--transport", choices=TRANSPORTS, default=DEFAULT_TRANSPORT,
+                       help="HTTP client: requests (HTTP/1.1) or httpx (HTTP/2 and brotli, needs httpx[http2]) "
+                            "(default: %(default)s)")
+    group.add_argument("--cache", metavar="PATH", help="on-disk response cache (SQLite file)")
+    group.add_argument("--cache-max-age", type=float, default=DEFAULT_MAX_AGE,
+                       help="seconds a cached page is used without revalidation (default: %(default)s)")
+    group.add_argument("--cache-size", type=float, default=DEFAULT_MAX_SIZE / (1024 * 1024),
+                       help="cache size cap in MB (default: %(default)s)")
+    group.add_argument("--journal", default=DEFAULT_JOURNAL_PATH, help="scrape journal (default: %(default)s)")
+    group.add_argument("--resume", action="store_true", help="only scrape churches missing from the journal")
+    group.add_argument("--incremental", action="store_true",
+                       help="skip parsing unchanged staff pages and export a 'Changes' sheet against --snapshot")
+    group.add_argument("--snapshot", default=DEFAULT_SNAPSHOT_PATH,
+                       help="staff snapshot used by --incremental (default: %(default)s)")
+
+def add_metrics_arguments(parser):
+    group = parser.add_argument_group("metrics")
+    group.add_argument("--metrics-json", metavar="PATH", help="write stage timings and request metrics as JSON")
+    group.add_argument("--metrics-prom", metavar="PATH",
+                       help="write the metrics in Prometheus text format, e.g. for the node_exporter textfile collector")
+
+PERSONS_HELP = ("export churches, deduplicated persons with normalised post number, town, phone and email, "
+                "and the links between them as separate sheets, instead of one row per staff member")
+
+def add_store_arguments(parser):
+    group = parser.add_argument_group("store")
+    group.add_argument("--store", metavar="PATH",
+                       help="also save the scraped churches and staff to this indexed SQLite store, which the "
+                            "query command reads and import-status without --input updates (e.g. %s)" % DEFAULT_STORE_PATH)
+
+def add_output_arguments(parser, persons=True, required=True):
+    parser.add_argument("--output", "-o", required=required, help="file to write")
+    # No default here, so a --format given before the command is kept
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default=argparse.SUPPRESS,
+                        help="output format (default: from the file extension)")
+    if persons:
+        parser.add_argument("--persons", action="store_true", default=argparse.SUPPRESS, help=PERSONS_HELP)
+
+def build_arg_parser():
+    # Scraping, status and format options go before the command and are shared by the commands
+    # and the interactive menu; the options after the command are specific to it.
+    parser = argparse.ArgumentParser(
+        prog="aiPythonScrape",
+        description="Scrape churches and staff from sogn.dk. Without a command the interactive menu is shown.")
+    parser.add_argument("--verbose", "-v", action="store_true", help="log debug messages")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="output format (default: from the file extension)")
+    parser.add_argument("--persons", action="store_true", help=PERSONS_HELP)
+    parser.add_argument("--status-file", help="CCLI spreadsheet with 'CCLI Num' and 'Account Status' columns")
+    parser.add_argument("--substring-match", action="store_true",
+                        help="match CCLI numbers anywhere inside the sogne_id, like older versions did")
+    add_scrape_arguments(parser)
+    add_region_arguments(parser)
+    add_store_arguments(parser)
+    add_metrics_arguments(parser)
+    # Older launch configurations pass these to the interactive menu
+    parser.add_argument("--arg1", help=argparse.SUPPRESS)
+    parser.add_argument("--arg2", dest="status_file", help=argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+
+    scrape = commands.add_parser("scrape", help="read the feed, scrape staff pages and export")
+    add_output_arguments(scrape)
+    scrape.add_argument("--no-staff", action="store_true", help="only read the church feed")
+    scrape.add_argument("--stream", action="store_true",
+                        help="stream churches from the feed to the output with bounded memory; "
+                             "staff pages are parsed in the download threads")
+    scrape.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help="churches in flight at once with --stream (default: %(default)s)")
+
+    import_status = commands.add_parser("import-status",
+                                        help="apply Account Status (--status-file) to an earlier export or the --store")
+    import_status.add_argument("--input", "-i", help="earlier export to read (default: update and export the --store)")
+    add_output_arguments(import_status)
+
+    export = commands.add_parser("export", help="convert an earlier export, or export the scrape journal")
+    source = export.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", "-i", help="earlier export to read")
+    source.add_argument("--from-journal", action="store_true", help="export the churches finished in --journal")
+    add_output_arguments(export)
+
+    # Sharded scrape: shard-plan once, shard-work on as many processes or hosts as wanted, then shard-merge
+    shard_plan = commands.add_parser("shard-plan", help="read the feed and split the churches into shards on a work queue")
+    shard_plan.add_argument("--queue", required=True, metavar="DIR", help="work-queue directory, may be on shared storage")
+    shard_plan.add_argument("--shards", type=int, default=DEFAULT_SHARDS, help="number of shards (default: %(default)s)")
+    shard_plan.add_argument("--shard-by", choices=SHARD_KEYS, default=DEFAULT_SHARD_KEY,
+                            help="provsti_id, or a hash of sogne_id for more even shards (default: %(default)s)")
+
+    shard_work = commands.add_parser("shard-work", help="claim and scrape shards from a work queue")
+    shard_work.add_argument("--queue", required=True, metavar="DIR", help="work-queue directory")
+    shard_work.add_argument("--processes", type=int, default=1,
+                            help="worker processes to start on this host (default: %(default)s)")
+    shard_work.add_argument("--max-shards", type=int, help="stop after this many shards")
+    shard_work.add_argument("--retry-failed", action="store_true", help="also claim shards that failed before")
+    shard_work.add_argument("--lease", type=float, default=DEFAULT_LEASE,
+                            help="seconds after which a claimed, unfinished shard is handed out again (default: %(default)s)")
+
+    shard_merge = commands.add_parser("shard-merge", help="combine the finished shards into one export")
+    shard_merge.add_argument("--queue", required=True, metavar="DIR", help="work-queue directory")
+    shard_merge.add_argument("--allow-partial", action="store_true", help="merge even if some shards are not done")
+    add_output_arguments(shard_merge)
+
+    nearby = commands.add_parser("nearby", help="find the churches nearest to points, or within a radius of them")
+    nearby.add_argument("--input", "-i", help="earlier export to take the churches from (default: read the feed)")
+    nearby.add_argument("--point", action="append", type=coordinates(("LAT", "LNG")), metavar="LAT,LNG",
+                        help="point to search from, can be repeated")
+    nearby.add_argument("--points", metavar="CSV", help="CSV file of points with 'lat', 'lng' and optionally 'name' columns")
+    match = nearby.add_mutually_exclusive_group()
+    match.add_argument("-k", type=int, default=1, help="number of nearest churches per point (default: %(default)s)")
+    match.add_argument("--radius", type=float, metavar="KM", help="every church within KM kilometres of each point")
+    add_output_arguments(nearby, persons=False)
+
+    query = commands.add_parser("query", help="look up churches and staff in the --store")
+    query.add_argument("--kirke-id", type=int, action="append", help="church to show, can be repeated")
+    query.add_argument("--sogne-id", type=int, help="churches of this parish")
+    query.add_argument("--provsti-id", type=int, help="churches of this deanery")
+    query.add_argument("--email", help="churches listing a staff member with this email address")
+    add_output_arguments(query, required=False)
+    return parser
+
+def setup_logger(interactive, verbose):
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG if interactive or verbose else logging.INFO)
+    if interactive:
+        # Create logger and formatter
+        import colorlog
+        handler = colorlog.StreamHandler()
+        handler.setFormatter(colorlog.ColoredFormatter(
+            "%(log_color)s%(levelname)s:%(message)s",
+            log_colors={
+                'DEBUG': 'cyan',
+                'INFO': 'white',
+                'WARNING': 'yellow',
+                'ERROR': 'red',
+                'CRITICAL': 'red,bg_white',
+            }))
+    else:
+        # Plain, timestamped lines for cron and container logs
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s:%(message)s"))
     logger.addHandler(handler)
+    # httpx logs every request at INFO and httpcore every connection step at DEBUG; the requests
+    # transport logs neither, and a staff scrape makes thousands of requests
+    for name in ("httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    return logger
+
+COMMANDS = {
+    "scrape": command_scrape,
+    "import-status": command_import_status,
+    "export": command_export,
+    "shard-plan": command_shard_plan,
+    "shard-work": command_shard_work,
+    "shard-merge": command_shard_merge,
+    "nearby": command_nearby,
+    "query": command_query,
+}
+
+def main(argv=None):
+    arg_parser = build_arg_parser()
+    options = arg_parser.parse_args(argv)
+    if options.transport == "httpx":
+        try:
+            import httpx_transport  # noqa: F401
+        except ImportError as e:
+            arg_parser.error("--transport httpx needs the httpx[http2] package (%s)" % e)
+    if options.command == "scrape" and options.stream and options.incremental:
+        arg_parser.error("--incremental needs the whole scrape in memory and can't be combined with --stream")
+    if options.command == "scrape" and options.stream and options.persons:
+        arg_parser.error("--persons needs the whole scrape in memory and can't be combined with --stream")
+    if options.command == "scrape" and options.window < 1:
+        arg_parser.error("--window must be at least 1")
+    if options.command == "shard-plan" and options.shards < 1:
+        arg_parser.error("--shards must be at least 1")
+    if options.bbox and (options.bbox[0] > options.bbox[2] or options.bbox[1] > options.bbox[3]):
+        arg_parser.error("--bbox is SOUTH,WEST,NORTH,EAST with SOUTH <= NORTH and WEST <= EAST")
+    if options.within and options.within[2] < 0:
+        arg_parser.error("--within needs a radius of 0 km or more")
+    if options.command == "nearby":
+        if not options.point and not options.points:
+            arg_parser.error("nearby needs --point or --points")
+        if options.k < 1:
+            arg_parser.error("-k must be at least 1")
+        if options.radius is not None and options.radius < 0:
+            arg_parser.error("--radius must be 0 km or more")
+    if options.command == "import-status" and not options.status_file:
+        arg_parser.error("import-status needs --status-file")
+    if options.command == "import-status" and not options.input and not options.store:
+        arg_parser.error("import-status needs --input or --store")
+    if options.command == "query" and not options.store:
+        arg_parser.error("query needs --store")
+    if options.adaptive_rate and options.max_rate <= 0:
+        arg_parser.error("--max-rate must be above 0")
+    logger = setup_logger(options.command is None, options.verbose)
+    METRICS.reset()
+    try:
+        if options.command is None:
+            interactive(options, logger)
+            return 0
+        return COMMANDS[options.command](options, logger)
+    finally:
+        write_metrics(options, logger)
 
+def write_metrics(options, logger):
+    for name, stage in METRICS.summary()["stages"].items():
+        logger.debug("Stage %s: %s calls, %.2f s wall, %.2f s CPU", name, stage["calls"], stage["wall"], stage["cpu"])
+    if options.metrics_json:
+        METRICS.write_json(options.metrics_json)
+        logger.info("Metrics written to %s", options.metrics_json)
+    if options.metrics_prom:
+        METRICS.write_prometheus(options.metrics_prom)
+        logger.info("Metrics written to %s", options.metrics_prom)
+
+def interactive(options, logger):
+    kirker = []
+    changes = None
     while True:
         logger.info("Press 1 to scrape new data from the web.")
         logger.info("Press 2 to import 'Account Status' field from an Excel file.")
         logger.info("Press E to exit.")
         choice = input("Enter your choice: ")
 
-        # Get the arguments passed to the script
-        args = sys.argv
         if choice == "1":
-            xml_data = get_xml_data("http://sogn.dk/xmlfeeds/kirker.php", logger)
-            if xml_data:
-                parse_kirke_xml(xml_data, kirker)
-                logger.info("%s churches found.", len(kirker))
+            transport = scrape_feed(kirker, options, logger)
+            if kirker:
                 scrape_priests_choice = input("Do you want to scrape information about priests for each church? (Y/n) ")
                 while scrape_priests_choice not in ["y", "n"]:
                     logger.warning("Invalid choice. Please try again.")
                     scrape_priests_choice = input("Do you want to scrape information about priests for each church? (Y/n) ")
+                if scrape_priests_choice == "n" and options.store:
+                    save_to_store(kirker, options, logger, staff=False)
                 if scrape_priests_choice == "y":
-                    for k in tqdm(kirker, total=len(kirker), desc="Scraping Priests Data"):
-                        scrape_priests(k, logger)
-                        time.sleep(0.5)
-            else:
-                logger.error("Unable to retrieve data from the web. Please try again.")
+                    snapshot = open_snapshot(options, logger)
+                    try:
+                        scrape_staff(kirker, options, transport, logger, snapshot)
+                        if snapshot is not None:
+                            # Saved straight away, since the menu may be left without exporting
+                            changes = snapshot.changes(kirker, logger)
+                            snapshot.save()
+                    finally:
+                        if snapshot is not None:
+                            snapshot.close()
+                    if options.store:
+                        save_to_store(kirker, options, logger)
 
         elif choice == "2":
-            if "--arg2" in args:
-                logger.debug("Running in debug mode")
-                # Get the index of the argument
-                arg_index = args.index("--arg2")
-                # Get the value of the argument
-                arg_value = args[arg_index + 1]
-                logger.debug(f"The value of --arg2 is: {arg_value}")
-                file_path_3 = arg_value
-                if not os.path.isfile(file_path_3):
-                    logger.warning("File not found. Please try again or check this path exists: {}", arg_value)
-                    continue
+            if options.status_file:
+                logger.debug("Using the status file given on the command line: %s", options.status_file)
+                file_path_3 = options.status_file
             else:
-                # Code to run when not in debug mode
+                from tkinter import filedialog, Tk
                 root = Tk()
                 root.withdraw()
                 file_path_3 = filedialog.askopenfilename(title="Select Excel file", filetypes=[("Excel files", "*.xlsx")])
                 if not file_path_3:
                     logger.warning("No file selected. Please try again.")
                     continue
-                if not os.path.isfile(file_path_3):
-                    logger.warning("File not found. Please try again.")
-                    continue
 
             # Read the Excel file
-            try:
-                df = pd.read_excel(file_path_3)
-                logger.info("%s rows loaded from %s", len(df.index), file_path_3)
-            except Exception as e:
-                logger.error("Error reading Excel file: %s", str(e))
-
-            # Update the account status of the Kirke objects based on the data in the DataFrame
-            for index, row in df.iterrows():
-                # 'CCLI Num' has sogne_id values.  This cell can have multiple sogne_ids
-                ccli_num = row['CCLI Num']
-                account_status = row['Account Status']
-                if pd.notna(ccli_num):
-                    ccli_nums = list(ccli_num.split(';'))
+            df = read_status_file(file_path_3, logger)
+            if df is None:
+                continue
 
-                    # Iterate over each ccli_num value
-                    for num in ccli_nums:
-                        # Define a lambda function to check if a Kirke object's sogne_id contains the ccli_num value
-                        matching_function = lambda kirke: num in str(kirke.sogne_id)
-
-                        # Use filter() to get a list of the matching Kirke objects
-                        matching_kirker_num = list(filter(matching_function, kirker))
-
-                        # Update the account status of the matching Kirke objects
-                        for kirke in matching_kirker_num:
-                            kirke.account_status = account_status
+            if options.store:
+                # Join against the store, which holds this session's scrape and earlier ones, and export its churches
+                store = KirkeStore(options.store)
+                try:
+                    import_account_status_into_store(df, store, logger, substring=options.substring_match)
+                    kirker[:] = store.kirker()
+                finally:
+                    store.close()
+            else:
+                # Update the account status of the Kirke objects based on the data in the DataFrame
+                import_account_status(df, kirker, logger, substring=options.substring_match)
 
-            save_to_excel(kirker, logger) 
+            save_to_excel(kirker, logger, options.format, changes, options.persons)
 
-        elif choice == "E":  
-            save_to_excel(kirker, logger)
-            sys.exit(0)
+        elif choice == "E":
+            save_to_excel(kirker, logger, options.format, changes, options.persons)
+            return
 
 if __name__ == '__main__':
-    kirker = []
-    main(kirker)
\ No newline at end of file
+    # Needed for the parser process pool in the frozen Windows build
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,480 @@
+import argparse
+import gzip
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import aiPythonScrape as scrape
+from http_transport import HttpTransport
+
+# The person_data markup documented in aiPythonScrape.py, one block per staff member
+PERSON_DATA = """<div class="person_data">
+    <div class="stilling pt-md-4 bigger-font"><font><font>{stilling}</font></font></div>
+    <div class="navn"><font><font>{navn}</font></font></div>
+    <div class="adr1"><font><font>{adr1}</font></font></div>
+    <div class="postnr_by"><font><font>{postnr_by}</font></font></div>
+    <div class="email"><a><font><font>{email}</font></font></a></div>
+    <div class="tlf"><font><font>Phone: {tlf}</font></font></div>
+    <div class="my-6"><a><font><font>Secure inquiry</font></font></a></div>
+</div>
+"""
+# Navigation and footer filler, so pages are roughly the size of the real ones
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html lang="da"><head><meta charset="utf-8"><title>{sognenavn} - Præster og medarbejdere</title></head>
+<body><nav><ul>{menu}</ul></nav>
+<main><h1>Præster og medarbejdere</h1>
+{people}</main>
+<footer>{footer}</footer></body></html>
+"""
+MENU_ITEM = '<li class="nav-item"><a class="nav-link" href="/sogn/{i}/">Menupunkt {i}</a></li>'
+# Markup the staff parsers are checked on besides the stand-in pages. Every backend is compared
+# with bs4; lxml is known to differ on implicit_close, where libxml2 ends the <p> at the <div>.
+PARSER_CASES = {
+    "empty": b"",
+    "script_style_template": b'<div class="person_data"><div class="adr1"><script>var x=1;</script>Vej 1</div>'
+                             b'<div class="navn"><style>.a{}</style>S<template>T</template><!-- c --></div></div>',
+    "crlf": b'<div class="person_data">\r\n<div\r\nclass="navn">A\r\nB</div></div>',
+    "nested_classes": b'<div class="person_data x"><div class="navn"><span class="navn">In</span>Out</div>'
+                      b'<div class="tlf">Phone: 1</div></div><div class="person_data"><div class="email">e</div></div>',
+    "entities": b'<div class="person_data"><div class="navn">&aelig;&amp;&#13;x&nbsp;y</div></div>',
+    "latin1": '<meta charset="iso-8859-1"><div class="person_data"><div class="navn">Søren</div></div>'.encode("latin-1"),
+    "indented": b'<div class="person_data">\n    <div class="navn">\n        <a href="/x">Jesper Bacher</a>\n    </div>\n'
+                b'    <div class="tlf"> <a>x</a> \n</div>\n    <div class="adr1"><pre>  </pre> \t<textarea>\n\n</textarea>'
+                b'</div>\n</div>',
+    "implicit_close": b'<p class="person_data"><div class="navn">P</div></p>',
+}
+STILLINGER = ("Sognepræst", "Kirkebogsfører", "Organist", "Kirketjener", "Graver", "Kordegn")
+
+
+class StandIn:
+    # Synthetic sogn.dk: a kirker.php feed and one praester-medarb page per parish
+    def __init__(self, churches, churches_per_parish, staff_per_page, seed=1):
+        self.churches = churches
+        self.churches_per_parish = max(1, churches_per_parish)
+        self.staff_per_page = staff_per_page
+        self.seed = seed
+        self.base_url = None
+        self.feed = None
+        self.pages = {}
+
+    def parish_count(self):
+        return (self.churches + self.churches_per_parish - 1) // self.churches_per_parish
+
+    def build(self, base_url):
+        self.base_url = base_url
+        rng = random.Random(self.seed)
+        parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<kirker>\n']
+        for i in range(self.churches):
+            parish = i // self.churches_per_parish
+            parts.append(
+                "<kirke><kirkeId>{i}</kirkeId><kirkenavn>{i} Kirke</kirkenavn><kirkeaddr1>Kirkevej {i}</kirkeaddr1>"
+                "<kirkeaddr2></kirkeaddr2><kirkepostnr>{postnr}</kirkepostnr><kirkeby>Kirkeby</kirkeby>"
+                "<lat>{lat:.6f}</lat><lng>{lng:.6f}</lng><provstiId>{provsti}</provstiId>"
+                "<provstinavn>Provsti {provsti}</provstinavn><sogneId>{sogne}</sogneId>"
+                "<sognenavn>Sogn {sogne}</sognenavn><sogndkurl>{base}/sogn/{sogne}/</sogndkurl></kirke>\n".format(
+                    i=i, postnr=1000 + parish % 8900, lat=rng.uniform(54.5, 57.7), lng=rng.uniform(8.1, 12.6),
+                    provsti=parish % 100, sogne=7000 + parish, base=base_url))
+        parts.append("</kirker>\n")
+        self.feed = "".join(parts).encode("utf-8")
+
+        menu = "".join(MENU_ITEM.format(i=i) for i in range(150))
+        footer = "Folkekirken " * 200
+        for parish in range(self.parish_count()):
+            sogne = 7000 + parish
+            people = "".join(PERSON_DATA.format(
+                stilling=STILLINGER[n % len(STILLINGER)], navn="Person %s-%s" % (sogne, n),
+                adr1="Præstegårdsvej %s" % n, postnr_by="%s Kirkeby" % (1000 + parish % 8900),
+                email="p%s.%s@km.dk" % (sogne, n), tlf="%08d" % rng.randrange(10 ** 8))
+                for n in range(self.staff_per_page))
+            page = PAGE_TEMPLATE.format(sognenavn="Sogn %s" % sogne, menu=menu, people=people, footer=footer)
+            self.pages["/sogn/%s/praester-medarb" % sogne] = page.encode("utf-8")
+
+
+class StandInResponder:
+    # The stand-in's answer to one GET, shared by the HTTP/1.1 and the HTTP/2 server. Counts
+    # requests, connections, errors and body bytes sent (after compression) in `stats`.
+    def __init__(self, stand_in, latency=0.0, jitter=0.0, error_rate=0.0, compression=None):
+        self.stand_in = stand_in
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.compression = compression
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + amount
+
+    def respond(self, path, request_headers):
+        # request_headers has lower-case names. Returns (status, [(header, value), ...], body).
+        self.count("requests")
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.count("errors")
+            return 503, [("retry-after", "1")], b""
+
+        path = path.split("?")[0]
+        if path == "/xmlfeeds/kirker.php":
+            body, content_type = self.stand_in.feed, "text/xml; charset=utf-8"
+        elif path in self.stand_in.pages:
+            body, content_type = self.stand_in.pages[path], "text/html; charset=utf-8"
+        else:
+            self.count("not_found")
+            return 404, [], b""
+
+        etag = '"%x"' % (hash(body) & 0xffffffff)
+        if request_headers.get("if-none-match") == etag:
+            self.count("not_modified")
+            return 304, [("etag", etag)], b""
+
+        headers = [("content-type", content_type), ("etag", etag)]
+        accepted = request_headers.get("accept-encoding", "")
+        if self.compression == "br" and "br" in accepted:
+            import brotli
+            body = brotli.compress(body, quality=5)
+            headers.append(("content-encoding", "br"))
+        elif self.compression and "gzip" in accepted:
+            body = gzip.compress(body, 5)
+            headers.append(("content-encoding", "gzip"))
+        self.count("bytes", len(body))
+        return 200, headers, body
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    responder = None
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.responder.count("connections")
+
+    def do_GET(self):
+        status, headers, body = self.responder.respond(self.path, {k.lower(): v for k, v in self.headers.items()})
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+
+def start_stand_in(stand_in, latency=0.0, jitter=0.0, error_rate=0.0, compression=None, port=0):
+    # Start the HTTP/1.1 stand-in server on a background thread.
+    # Returns the server; its base URL is server.base_url and its counters server.responder.stats.
+    responder = StandInResponder(stand_in, latency, jitter, error_rate, compression)
+    handler = type("Handler", (StandInHandler,), {"responder": responder})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.base_url = "http://127.0.0.1:%s" % server.server_address[1]
+    server.responder = responder
+    stand_in.build(server.base_url)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class H2StandInServer:
+    # HTTP/2 over plain TCP with prior knowledge (h2c), which HttpxTransport(prior_knowledge=True)
+    # speaks. Every request stream is answered on its own thread, so a slow page doesn't hold up
+    # the others on the connection; DATA frames respect the client's flow-control window.
+    # Needs the h2 package.
+    def __init__(self, responder, port=0):
+        self.responder = responder
+        self.socket = socket.create_server(("127.0.0.1", port))
+        self.base_url = "http://127.0.0.1:%s" % self.socket.getsockname()[1]
+
+    def serve_forever(self):
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(client,), daemon=True).start()
+
+    def shutdown(self):
+        self.socket.close()
+
+    def handle(self, client):
+        import h2.config
+        import h2.connection
+        import h2.events
+        import h2.exceptions
+        self.responder.count("connections")
+        connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+        # Guards the connection state; answering threads wait on it for flow-control window updates
+        condition = threading.Condition()
+        try:
+            with condition:
+                connection.initiate_connection()
+                client.sendall(connection.data_to_send())
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                with condition:
+                    for event in connection.receive_data(data):
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(target=self.answer, daemon=True,
+                                             args=(client, connection, condition, event.stream_id, dict(event.headers))).start()
+                        elif isinstance(event, (h2.events.WindowUpdated, h2.events.StreamReset)):
+                            condition.notify_all()
+                    client.sendall(connection.data_to_send())
+        except (OSError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            client.close()
+
+    def answer(self, client, connection, condition, stream_id, request_headers):
+        import h2.exceptions
+        status, headers, body = self.responder.respond(request_headers[":path"], request_headers)
+        try:
+            with condition:
+                connection.send_headers(stream_id, [(":status", str(status)), ("content-length", str(len(body)))] + headers,
+                                        end_stream=not body)
+                client.sendall(connection.data_to_send())
+            while body:
+                with condition:
+                    while connection.local_flow_control_window(stream_id) <= 0:
+                        condition.wait()
+                    size = min(connection.local_flow_control_window(stream_id), connection.max_outbound_frame_size, len(body))
+                    connection.send_data(stream_id, body[:size], end_stream=size == len(body))
+                    client.sendall(connection.data_to_send())
+                body = body[size:]
+        except (OSError, h2.exceptions.StreamClosedError, h2.exceptions.ProtocolError):
+            pass
+
+
+def start_h2_stand_in(stand_in, latency=0.0, jitter=0.0, error_rate=0.0, compression=None, port=0):
+    # The HTTP/2 (h2c) counterpart of start_stand_in
+    server = H2StandInServer(StandInResponder(stand_in, latency, jitter, error_rate, compression), port)
+    stand_in.build(server.base_url)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def timed(function, *args, **kwargs):
+    # The stand-in runs in this process, so the cpu figure of network stages includes serving the pages
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - wall, time.process_time() - cpu
+
+
+def reset_stats(server):
+    server.responder.stats.clear()
+
+
+def bench_feed(server, logger, repeat):
+    url = server.base_url + "/xmlfeeds/kirker.php"
+    results = []
+    for _ in range(repeat):
+        transport = HttpTransport(logger=logger)
+        xml_data = scrape.get_xml_data(url, logger, transport)
+        kirker = []
+        _, wall, cpu = timed(scrape.parse_kirke_xml, xml_data, kirker)
+        results.append({"stage": "feed_parse", "mode": "string", "wall": wall, "cpu": cpu, "churches": len(kirker)})
+        kirker, wall, cpu = timed(lambda: list(scrape.stream_kirke_xml(url, logger, transport)))
+        results.append({"stage": "feed_parse", "mode": "stream", "wall": wall, "cpu": cpu, "churches": len(kirker)})
+        transport.close()
+    return results, kirker
+
+
+# Transports compared by the scrape stage: requests and httpx against the HTTP/1.1 stand-in
+# (httpx then differs only in compression), and httpx multiplexing over HTTP/2 against the h2c stand-in
+BENCH_TRANSPORTS = ("requests", "httpx", "httpx-h2")
+
+
+def bench_transport(kind, pool_size, logger):
+    if kind == "requests":
+        return HttpTransport(pool_size=pool_size, logger=logger)
+    from httpx_transport import HttpxTransport
+    return HttpxTransport(pool_size=pool_size, logger=logger, prior_knowledge=kind == "httpx-h2")
+
+
+def bench_scrape(server, kirker, logger, concurrency_levels, rate, parser, parse_workers, repeat, transport_kind="requests"):
+    results = []
+    for concurrency in concurrency_levels:
+        for _ in range(repeat):
+            for k in kirker:
+                k.staff = []
+            transport = bench_transport(transport_kind, concurrency, logger)
+            reset_stats(server)
+            _, wall, cpu = timed(scrape.scrape_all_priests, kirker, logger, concurrency=concurrency, rate=rate,
+                                 transport=transport, parser=parser, parse_workers=parse_workers)
+            transport.close()
+            stats = dict(server.responder.stats)
+            results.append({
+                "stage": "staff_scrape", "transport": transport_kind, "concurrency": concurrency, "rate": rate,
+                "parser": parser, "parse_workers": parse_workers, "wall": wall, "cpu": cpu, "churches": len(kirker),
+                "pages_per_second": stats.get("requests", 0) / wall if wall else None,
+                "staff": sum(len(k.staff) for k in kirker), "server": stats})
+    return results
+
+
+def staff_values(staff):
+    return [tuple(getattr(s, field) for field in scrape.STAFF_FIELDS) for s in staff]
+
+
+def bench_parsers(stand_in, logger, repeat):
+    # Time every staff parser on the stand-in pages, and list the pages and PARSER_CASES on which
+    # its Staff values differ from the bs4 parser's
+    cases = dict(PARSER_CASES)
+    cases.update(stand_in.pages)
+    expected = {name: staff_values(scrape.parse_staff_bs4(content)) for name, content in cases.items()}
+    results = []
+    for parser in sorted(scrape.STAFF_PARSERS):
+        try:
+            mismatches = [name for name, content in cases.items()
+                          if staff_values(scrape.parse_staff_html(content, parser)) != expected[name]]
+        except ImportError as e:
+            results.append({"stage": "staff_parse", "parser": parser, "skipped": str(e)})
+            continue
+        for name in mismatches:
+            logger.warning("The %s parser differs from bs4 on %s", parser, name)
+        for _ in range(repeat):
+            _, wall, cpu = timed(lambda: [scrape.parse_staff_html(page, parser) for page in stand_in.pages.values()])
+            results.append({"stage": "staff_parse", "parser": parser, "pages": len(stand_in.pages),
+                            "wall": wall, "cpu": cpu, "mismatches": mismatches})
+    return results
+
+
+def bench_import(kirker, logger, rows, repeat):
+    import pandas as pd
+    rng = random.Random(2)
+    sogne_ids = sorted({k.sogne_id for k in kirker})
+    data = [(";".join(str(rng.choice(sogne_ids)) for _ in range(rng.randint(1, 3))), "Status %s" % (n % 5))
+            for n in range(rows)]
+    df = pd.DataFrame(data, columns=["CCLI Num", "Account Status"])
+    results = []
+    for substring in (False, True):
+        for _ in range(repeat):
+            _, wall, cpu = timed(scrape.import_account_status, df, kirker, logger, substring)
+            results.append({"stage": "account_status_import", "substring": substring, "rows": rows,
+                            "wall": wall, "cpu": cpu})
+    return results
+
+
+def bench_export(kirker, logger, formats, repeat):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for fmt in formats:
+            for _ in range(repeat):
+                file_path = os.path.join(directory, "bench." + fmt)
+                try:
+                    _, wall, cpu = timed(scrape.export_kirker, kirker, file_path, logger, fmt)
+                except ImportError as e:
+                    results.append({"stage": "export", "format": fmt, "skipped": str(e)})
+                    break
+                results.append({"stage": "export", "format": fmt, "wall": wall, "cpu": cpu,
+                                "bytes": os.path.getsize(file_path)})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the scraper against a local sogn.dk stand-in server.")
+    parser.add_argument("--churches", type=int, default=2000)
+    parser.add_argument("--churches-per-parish", type=int, default=2)
+    parser.add_argument("--staff-per-page", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.02, help="random extra latency, up to this many seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--compression", choices=("gzip", "br"),
+                        help="compress responses when the client accepts it (br falls back to gzip)")
+    parser.add_argument("--gzip", dest="compression", action="store_const", const="gzip", help=argparse.SUPPRESS)
+    parser.add_argument("--transports", default="requests",
+                        help="comma-separated transports for the scrape stage: %s" % ", ".join(BENCH_TRANSPORTS))
+    parser.add_argument("--concurrency", default="1,4,8,16", help="comma-separated concurrency levels")
+    parser.add_argument("--rate", type=float, default=0, help="requests per second per host, 0 for no limit")
+    parser.add_argument("--parser", default=scrape.DEFAULT_STAFF_PARSER, choices=sorted(scrape.STAFF_PARSERS))
+    parser.add_argument("--parse-workers", type=int, default=0)
+    parser.add_argument("--import-rows", type=int, default=5000)
+    parser.add_argument("--formats", default="xlsx,csv,sqlite", help="comma-separated export formats")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--stages", default="feed,parsers,scrape,import,export", help="comma-separated stages to run")
+    parser.add_argument("--serve", action="store_true", help="only run the stand-in server until interrupted")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json")
+    options = parser.parse_args(argv)
+    transports = options.transports.split(",")
+    unknown = [kind for kind in transports if kind not in BENCH_TRANSPORTS]
+    if unknown:
+        parser.error("unknown transport %s; choose from %s" % (", ".join(unknown), ", ".join(BENCH_TRANSPORTS)))
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s:%(message)s")
+    logger = logging.getLogger("benchmark")
+    stand_in = StandIn(options.churches, options.churches_per_parish, options.staff_per_page)
+    server = start_stand_in(stand_in, options.latency, options.jitter, options.error_rate, options.compression,
+                            options.port)
+    if options.serve:
+        print("Serving %s churches in %s parishes at %s/xmlfeeds/kirker.php" %
+              (options.churches, stand_in.parish_count(), server.base_url))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return 0
+
+    stages = options.stages.split(",")
+    results = []
+    feed_results, kirker = bench_feed(server, logger, options.repeat)
+    if "feed" in stages:
+        results += feed_results
+    if "parsers" in stages:
+        results += bench_parsers(stand_in, logger, options.repeat)
+    if "scrape" in stages:
+        levels = [int(level) for level in options.concurrency.split(",")]
+        for kind in transports:
+            if kind == "httpx-h2":
+                # Same synthetic site on an h2c server; its feed is read through the h2 transport too
+                h2_server = start_h2_stand_in(
+                    StandIn(options.churches, options.churches_per_parish, options.staff_per_page),
+                    options.latency, options.jitter, options.error_rate, options.compression)
+                transport = bench_transport(kind, 1, logger)
+                h2_kirker = list(scrape.stream_kirke_xml(h2_server.base_url + "/xmlfeeds/kirker.php", logger, transport))
+                transport.close()
+                results += bench_scrape(h2_server, h2_kirker, logger, levels, options.rate, options.parser,
+                                        options.parse_workers, options.repeat, kind)
+                h2_server.shutdown()
+            else:
+                results += bench_scrape(server, kirker, logger, levels, options.rate, options.parser,
+                                        options.parse_workers, options.repeat, kind)
+    if "import" in stages:
+        results += bench_import(kirker, logger, options.import_rows, options.repeat)
+    if "export" in stages:
+        results += bench_export(kirker, logger, options.formats.split(","), options.repeat)
+    server.shutdown()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "config": vars(options),
+        "results": results,
+    }
+    with open(options.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    for result in results:
+        if "wall" in result:
+            details = ", ".join("%s=%s" % (key, value) for key, value in result.items()
+                                if key not in ("stage", "wall", "cpu", "server"))
+            print("%-22s %8.3f s wall %8.3f s cpu  %s" % (result["stage"], result["wall"], result["cpu"], details))
+    print("Results written to %s" % options.output)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
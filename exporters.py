@@ -0,0 +1,205 @@
+import csv
+import math
+import os.path
+import sqlite3
+
+# Rows are written as they are produced, in batches of this size where the backend wants batches
+BATCH_SIZE = 10000
+
+EXPORT_FORMATS = ("xlsx", "csv", "parquet", "sqlite")
+EXTENSION_FORMATS = {
+    ".xlsx": "xlsx",
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".sqlite": "sqlite",
+    ".sqlite3": "sqlite",
+    ".db": "sqlite",
+}
+
+
+def format_from_path(file_path):
+    return EXTENSION_FORMATS.get(os.path.splitext(file_path)[1].lower(), "xlsx")
+
+
+def clean_value(value):
+    # pandas hands back NaN for empty cells and numpy scalars for numbers; write them as plain values
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        return value.item()
+    return value
+
+
+def append_worksheet(workbook, rows, columns, sheet_name):
+    worksheet = workbook.create_sheet(sheet_name)
+    worksheet.append(list(columns))
+    count = 0
+    for row in rows:
+        worksheet.append([clean_value(value) for value in row])
+        count += 1
+    return count
+
+
+def write_xlsx(rows, columns, file_path, sheet_name):
+    # openpyxl write-only mode streams each row to disk instead of keeping the sheet in memory
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    count = append_worksheet(workbook, rows, columns, sheet_name)
+    workbook.save(file_path)
+    return count
+
+
+def write_csv(rows, columns, file_path, sheet_name):
+    count = 0
+    with open(file_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([clean_value(value) for value in row])
+            count += 1
+    return count
+
+
+def iter_batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def write_sqlite(rows, columns, file_path, sheet_name):
+    # SQLite column names are case-insensitive, so of 'Kirke_id' and 'kirke_id' only the first is kept
+    keep = []
+    seen = set()
+    for position, column in enumerate(columns):
+        if column.lower() not in seen:
+            seen.add(column.lower())
+            keep.append(position)
+    table = sheet_name.lower().replace(" ", "_")
+    column_sql = ", ".join('"%s"' % columns[position] for position in keep)
+    placeholders = ", ".join("?" for _ in keep)
+    count = 0
+    connection = sqlite3.connect(file_path)
+    try:
+        connection.execute('DROP TABLE IF EXISTS "%s"' % table)
+        connection.execute('CREATE TABLE "%s" (%s)' % (table, column_sql))
+        insert = 'INSERT INTO "%s" (%s) VALUES (%s)' % (table, column_sql, placeholders)
+        for batch in iter_batches(rows):
+            connection.executemany(insert, [[clean_value(row[position]) for position in keep] for row in batch])
+            count += len(batch)
+        connection.commit()
+    finally:
+        connection.close()
+    return count
+
+
+def parquet_type(values):
+    # The Arrow type of a column, from its values in the first batch: a column of numbers or of
+    # booleans keeps that type, anything else (text, empty, or mixed like a status that is
+    # sometimes a number) is written as text
+    import pyarrow as pa
+    kinds = {type(value) for value in values if value is not None}
+    if kinds == {bool}:
+        return pa.bool_()
+    if kinds == {int}:
+        return pa.int64()
+    if kinds and kinds <= {int, float}:
+        return pa.float64()
+    return pa.string()
+
+
+def text_values(values):
+    return [value if value is None or isinstance(value, str) else str(value) for value in values]
+
+
+def write_parquet(rows, columns, file_path, sheet_name):
+    # Needs the optional pyarrow package. The schema is taken from the first batch (see
+    # parquet_type); values of text columns are written as text in every batch.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    count = 0
+    try:
+        for batch in iter_batches(rows):
+            data = {column: [clean_value(row[position]) for row in batch] for position, column in enumerate(columns)}
+            if writer is None:
+                schema = pa.schema([pa.field(column, parquet_type(values)) for column, values in data.items()])
+                writer = pq.ParquetWriter(file_path, schema)
+            for field in writer.schema:
+                if pa.types.is_string(field.type):
+                    data[field.name] = text_values(data[field.name])
+            writer.write_table(pa.Table.from_pydict(data, schema=writer.schema))
+            count += len(batch)
+        if writer is None:
+            writer = pq.ParquetWriter(file_path, pa.schema([pa.field(column, pa.string()) for column in columns]))
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+WRITERS = {
+    "xlsx": write_xlsx,
+    "csv": write_csv,
+    "parquet": write_parquet,
+    "sqlite": write_sqlite,
+}
+
+
+def write_rows(rows, columns, file_path, fmt=None, sheet_name="Kirker and Staff"):
+    # Write an iterable of row tuples to file_path. The format is taken from fmt or from the file extension.
+    # Returns the number of rows written.
+    fmt = fmt or format_from_path(file_path)
+    if fmt not in WRITERS:
+        raise ValueError("Unknown export format %s. Choose one of: %s" % (fmt, ", ".join(EXPORT_FORMATS)))
+    return WRITERS[fmt](rows, columns, file_path, sheet_name)
+
+
+def sheet_path(file_path, sheet_name):
+    # Where a csv or parquet export puts an extra sheet: 'kirker.csv' -> 'kirker.changes.csv'
+    stem, extension = os.path.splitext(file_path)
+    return "%s.%s%s" % (stem, sheet_name.lower().replace(" ", "_"), extension)
+
+
+def write_sheets(sheets, file_path, fmt=None):
+    # Write several (sheet_name, columns, rows) sheets. xlsx gets a worksheet per sheet and sqlite a
+    # table per sheet; csv and parquet hold one table, so every sheet after the first goes to its
+    # own file next to file_path (see sheet_path). Returns the number of rows written per sheet.
+    fmt = fmt or format_from_path(file_path)
+    if fmt not in WRITERS:
+        raise ValueError("Unknown export format %s. Choose one of: %s" % (fmt, ", ".join(EXPORT_FORMATS)))
+    if fmt == "xlsx":
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        counts = [append_worksheet(workbook, rows, columns, sheet_name) for sheet_name, columns, rows in sheets]
+        workbook.save(file_path)
+        return counts
+    counts = []
+    for position, (sheet_name, columns, rows) in enumerate(sheets):
+        path = file_path if position == 0 or fmt == "sqlite" else sheet_path(file_path, sheet_name)
+        counts.append(WRITERS[fmt](rows, columns, path, sheet_name))
+    return counts
+
+
+def write_table(table, file_path, fmt=None, sheet_name="Kirker and Staff"):
+    # Write a whole pandas DataFrame or pyarrow Table. Parquet goes straight through pyarrow,
+    # the other formats are written row by row. Returns the number of rows written.
+    fmt = fmt or format_from_path(file_path)
+    if fmt == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not isinstance(table, pa.Table):
+            table = pa.Table.from_pandas(table, preserve_index=False)
+        pq.write_table(table, file_path)
+        return table.num_rows
+    if hasattr(table, "itertuples"):
+        columns = list(table.columns)
+        rows = table.itertuples(index=False, name=None)
+    else:
+        columns = table.column_names
+        rows = zip(*(table.column(column).to_pylist() for column in columns))
+    return write_rows(rows, columns, file_path, fmt, sheet_name)
@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+# Seconds a cached response is reused without asking the server. 0 means always revalidate.
+DEFAULT_MAX_AGE = 0
+
+
+class CacheEntry:
+    def __init__(self, url, body, etag, last_modified, content_type, fetched_at):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, max_age):
+        return max_age > 0 and time.time() - self.fetched_at < max_age
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    # Persistent response cache keyed by URL. Bodies are stored zlib-compressed in a single
+    # SQLite file together with their ETag/Last-Modified validators. When the total compressed
+    # size goes above max_size the least recently used entries are evicted.
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_type TEXT,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+        self.connection.commit()
+        self.total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def lookup(self, url):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT body, etag, last_modified, content_type, fetched_at FROM responses WHERE url = ?",
+                (url,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET accessed_at = ? WHERE url = ?", (time.time(), url))
+            self.connection.commit()
+        body, etag, last_modified, content_type, fetched_at = row
+        return CacheEntry(url, zlib.decompress(body), etag, last_modified, content_type, fetched_at)
+
+    def store(self, url, body, etag=None, last_modified=None, content_type=None):
+        self.store_compressed(url, zlib.compress(body), etag, last_modified, content_type)
+
+    def store_compressed(self, url, compressed, etag=None, last_modified=None, content_type=None):
+        now = time.time()
+        with self.lock:
+            old = self.connection.execute("SELECT size FROM responses WHERE url = ?", (url,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, compressed, len(compressed), etag, last_modified, content_type, now, now))
+            self.total_size += len(compressed) - (old[0] if old else 0)
+            self._evict()
+            self.connection.commit()
+
+    def revalidated(self, url):
+        # The server answered 304, so the cached body counts as freshly fetched again
+        now = time.time()
+        with self.lock:
+            self.connection.execute("UPDATE responses SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url))
+            self.connection.commit()
+
+    def _evict(self):
+        while self.total_size > self.max_size:
+            row = self.connection.execute(
+                "SELECT url, size FROM responses ORDER BY accessed_at LIMIT 1").fetchone()
+            if row is None:
+                break
+            self.connection.execute("DELETE FROM responses WHERE url = ?", (row[0],))
+            self.total_size -= row[1]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
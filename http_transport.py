@@ -0,0 +1,233 @@
+import random
+import threading
+import time
+import logging
+import zlib
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from metrics import METRICS
+
+# Connect and read timeouts in seconds. Without a read timeout a hung socket stalls a worker forever.
+DEFAULT_TIMEOUT = (5, 30)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_POOL_SIZE = 8
+DEFAULT_RETRIES = 4
+DEFAULT_BACKOFF = 0.5
+MAX_BACKOFF = 30.0
+# Never sleep longer than this on a Retry-After header, however large the server asks for
+MAX_RETRY_AFTER = 120.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# "requests" is HTTP/1.1 over requests; "httpx" needs the optional httpx[http2] package (see httpx_transport.py)
+TRANSPORTS = ("requests", "httpx")
+DEFAULT_TRANSPORT = "requests"
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+def cached_response(entry):
+    # Build a requests.Response around a cache entry so callers can't tell the difference
+    response = requests.Response()
+    response.status_code = 200
+    response.url = entry.url
+    response.headers = CaseInsensitiveDict()
+    if entry.content_type:
+        response.headers["Content-Type"] = entry.content_type
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = entry.body
+    response._content_consumed = True
+    response.from_cache = True
+    return response
+
+
+class HttpTransport:
+    # One keep-alive session shared by get_xml_data and scrape_priests. The connection pool is
+    # sized to the scrape concurrency, every request has a timeout, and connection errors and
+    # 5xx/429 responses are retried with exponential backoff, full jitter and Retry-After.
+    # With a ResponseCache attached, revisits send If-None-Match/If-Modified-Since and a 304
+    # answer is served from the cached body. Streamed responses are stored once iter_content()
+    # has read them to the end. Every attempt, retry and cache outcome is counted in METRICS,
+    # and reported to the observers added with add_observer(). Retries wait for the throttles
+    # added with add_throttle(), so they keep to the same rate limit as first attempts.
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, max_backoff=MAX_BACKOFF, logger=None, cache=None):
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.logger = logger or logging.getLogger(__name__)
+        self.observers = []
+        self.throttles = []
+        self.session = self.open_session(pool_size)
+
+    # open_session, send and iter_body are the only places that talk to the HTTP library, so a
+    # subclass can swap it out and keep the retries, the cache, the metrics and the observers
+
+    def open_session(self, pool_size):
+        session = requests.Session()
+        # Retries are handled in request() so they can be logged and honour Retry-After
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def send(self, url, stream=False, headers=None):
+        # One attempt. Returns a requests.Response, raises requests' ConnectionError or Timeout.
+        return self.session.get(url, timeout=self.timeout, stream=stream, headers=headers)
+
+    def iter_body(self, response, chunk_size):
+        return response.iter_content(chunk_size)
+
+    def add_observer(self, observer):
+        # observer(url, status, latency, retry_after) is called after every attempt, retries included.
+        # status is None when the request failed without a response.
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        self.observers.remove(observer)
+
+    def notify(self, url, status, latency, retry_after=None):
+        for observer in list(self.observers):
+            observer(url, status, latency, retry_after)
+
+    def add_throttle(self, throttle):
+        # throttle(url) is called before every retry, after the backoff, and may sleep until the
+        # retry is allowed to go out. The first attempt is paced by the caller.
+        self.throttles.append(throttle)
+
+    def remove_throttle(self, throttle):
+        self.throttles.remove(throttle)
+
+    def backoff_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def get(self, url, stream=False, headers=None):
+        if self.cache is None:
+            return self.request(url, stream=stream, headers=headers)
+
+        entry = self.cache.lookup(url)
+        if entry is not None:
+            if entry.is_fresh(self.cache.max_age):
+                METRICS.record_cache(url, "hit")
+                return cached_response(entry)
+            headers = dict(headers or {}, **entry.conditional_headers())
+
+        response = self.request(url, stream=stream, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            self.cache.revalidated(url)
+            METRICS.record_cache(url, "revalidated")
+            return cached_response(entry)
+        METRICS.record_cache(url, "miss")
+        if response.status_code == 200 and not stream:
+            self.cache.store(url, response.content, response.headers.get("ETag"),
+                             response.headers.get("Last-Modified"), response.headers.get("Content-Type"))
+        response.from_cache = False
+        # A streamed body is stored by iter_content(), under the URL asked for rather than
+        # response.url, which is where any redirects ended up and which get() never looks up
+        response.cache_url = url
+        return response
+
+    def iter_content(self, response, chunk_size=DEFAULT_CHUNK_SIZE):
+        # Yield the body of a get(stream=True) response in chunks. A fresh 200 response is
+        # compressed on the fly and written to the cache after the last chunk.
+        if getattr(response, "from_cache", False):
+            yield from response.iter_content(chunk_size)
+            return
+        store = self.cache is not None and response.status_code == 200 and hasattr(response, "cache_url")
+        compressor = zlib.compressobj()
+        parts = []
+        size = 0
+        for chunk in self.iter_body(response, chunk_size):
+            size += len(chunk)
+            if store:
+                parts.append(compressor.compress(chunk))
+            yield chunk
+        METRICS.record_size(response.url, size)
+        if not store:
+            return
+        parts.append(compressor.flush())
+        self.cache.store_compressed(response.cache_url, b"".join(parts), response.headers.get("ETag"),
+                                    response.headers.get("Last-Modified"), response.headers.get("Content-Type"))
+
+    def request(self, url, stream=False, headers=None):
+        # For streamed responses the latency is the time to the headers; the body size is
+        # recorded by iter_content()
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self.send(url, stream=stream, headers=headers)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                latency = time.perf_counter() - started
+                METRICS.record_request(url, "error", latency)
+                self.notify(url, None, latency)
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                self.logger.warning("Request to %s failed (%s), retrying in %.1f s", url, e, delay)
+            else:
+                latency = time.perf_counter() - started
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                METRICS.record_request(url, response.status_code, latency, None if stream else len(response.content))
+                self.notify(url, response.status_code, latency, retry_after)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                if retry_after is not None:
+                    delay = min(retry_after, MAX_RETRY_AFTER)
+                else:
+                    delay = self.backoff_delay(attempt)
+                response.close()
+                self.logger.warning("Request to %s returned HTTP %s, retrying in %.1f s", url, response.status_code, delay)
+            METRICS.record_retry(url)
+            time.sleep(delay)
+            for throttle in list(self.throttles):
+                throttle(url)
+            attempt += 1
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def create_transport(kind=DEFAULT_TRANSPORT, **kwargs):
+    # HttpTransport, or the httpx-based HttpxTransport for kind="httpx"
+    if kind == "httpx":
+        from httpx_transport import HttpxTransport
+        return HttpxTransport(**kwargs)
+    if kind != "requests":
+        raise ValueError("Unknown transport %s. Choose one of: %s" % (kind, ", ".join(TRANSPORTS)))
+    return HttpTransport(**kwargs)
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    # Shared transport for callers that don't pass their own
+    global _default_transport
+    with _default_transport_lock:
+        if _default_transport is None:
+            _default_transport = HttpTransport()
+        return _default_transport
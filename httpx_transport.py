@@ -0,0 +1,111 @@
+import asyncio
+import threading
+
+import h2  # noqa: F401  (the client always offers HTTP/2, which httpx only does with h2 installed)
+import httpx
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from http_transport import HttpTransport
+
+try:
+    import brotli  # noqa: F401  (httpx decodes br only when a brotli package is installed)
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "br, gzip, deflate"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+
+def translate_errors(function):
+    # Run function() and raise requests' exceptions for httpx's, which is what callers catch
+    try:
+        return function()
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.Timeout(str(e))
+    except httpx.TransportError as e:
+        raise requests.exceptions.ConnectionError(str(e))
+
+
+class StreamedBody:
+    # requests.Response.raw for a streamed response: reads and closes the httpx response on the
+    # transport's event loop
+    def __init__(self, transport, response):
+        self.transport = transport
+        self.response = response
+
+    def iter_bytes(self, chunk_size):
+        chunks = self.response.aiter_bytes(chunk_size)
+        while True:
+            try:
+                yield translate_errors(lambda: self.transport.run(chunks.__anext__()))
+            except StopAsyncIteration:
+                return
+
+    def close(self):
+        self.transport.run(self.response.aclose())
+
+
+def wrap_response(response, raw):
+    # Present an httpx.Response as a requests.Response, so callers keep using raise_for_status(),
+    # .content, .text and requests' exceptions. A streamed body is read with HttpxTransport.iter_content().
+    wrapped = requests.Response()
+    wrapped.status_code = response.status_code
+    wrapped.reason = response.reason_phrase
+    wrapped.url = str(response.url)
+    wrapped.headers = CaseInsensitiveDict(response.headers)
+    wrapped.encoding = get_encoding_from_headers(wrapped.headers)
+    wrapped.http_version = response.http_version
+    wrapped.raw = raw
+    if raw is None:
+        wrapped._content = response.content
+        wrapped._content_consumed = True
+    return wrapped
+
+
+class HttpxTransport(HttpTransport):
+    # Drop-in alternative to HttpTransport built on httpx: HTTP/2 where the server offers it
+    # (ALPN over https), multiplexing the concurrent requests over one connection per host, and
+    # explicit gzip/brotli negotiation. prior_knowledge=True speaks HTTP/2 over plain http
+    # (h2c), which is what the benchmark's local stand-in serves. Needs httpx[http2].
+    # httpx's synchronous client isn't safe for concurrent requests on one HTTP/2 connection, so
+    # an AsyncClient runs on a private event loop thread and the worker threads wait on it.
+    def __init__(self, prior_knowledge=False, **kwargs):
+        self.prior_knowledge = prior_knowledge
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name="httpx-transport", daemon=True)
+        self.loop_thread.start()
+        super().__init__(**kwargs)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def open_session(self, pool_size):
+        connect_timeout, read_timeout = self.timeout
+        # pool_size caps the connections per host. Over HTTP/2 every concurrent request is a stream
+        # on one connection, so more are only opened for servers that fall back to HTTP/1.1.
+        return httpx.AsyncClient(
+            http1=not self.prior_knowledge, http2=True,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=None),
+            headers={"Accept-Encoding": ACCEPT_ENCODING},
+            follow_redirects=True)
+
+    def send(self, url, stream=False, headers=None):
+        request = self.session.build_request("GET", url, headers=headers)
+        response = translate_errors(lambda: self.run(self.session.send(request, stream=stream)))
+        return wrap_response(response, StreamedBody(self, response) if stream else None)
+
+    def iter_body(self, response, chunk_size):
+        return response.raw.iter_bytes(chunk_size)
+
+    def close(self):
+        self.run(self.session.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,103 @@
+import sqlite3
+import time
+
+from records import Staff, STAFF_FIELDS
+
+DEFAULT_JOURNAL_PATH = "scrape_journal.sqlite"
+
+
+class ScrapeJournal:
+    # Local SQLite record of the staff scrape. Every finished church is committed together with
+    # its staff rows, the HTTP status of its page and a timestamp, so an interrupted run can be
+    # resumed with only the missing and failed churches left to scrape.
+    def __init__(self, path=DEFAULT_JOURNAL_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS churches (
+                kirke_id INTEGER PRIMARY KEY,
+                sogndk_url TEXT,
+                ok INTEGER NOT NULL,
+                http_status INTEGER,
+                error TEXT,
+                finished_at REAL NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS staff (
+                kirke_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                %s,
+                PRIMARY KEY (kirke_id, position)
+            )""" % ", ".join("%s TEXT" % field for field in STAFF_FIELDS))
+        self.connection.commit()
+
+    def reset(self):
+        self.connection.execute("DELETE FROM churches")
+        self.connection.execute("DELETE FROM staff")
+        self.connection.commit()
+
+    def record(self, kirker, staff, http_status=None, error=None):
+        # Commit the outcome of one staff page for every church that shares it.
+        # staff is None when the page could not be scraped.
+        now = time.time()
+        ok = staff is not None
+        placeholders = ", ".join("?" for _ in STAFF_FIELDS)
+        with self.connection:
+            for kirke in kirker:
+                self.connection.execute("INSERT OR REPLACE INTO churches VALUES (?, ?, ?, ?, ?, ?)",
+                                        (kirke.kirke_id, kirke.sogndk_url, int(ok), http_status, error, now))
+                self.connection.execute("DELETE FROM staff WHERE kirke_id = ?", (kirke.kirke_id,))
+                if ok:
+                    self.connection.executemany(
+                        "INSERT INTO staff VALUES (?, ?, %s)" % placeholders,
+                        [(kirke.kirke_id, position) + tuple(getattr(s, field) for field in STAFF_FIELDS)
+                         for position, s in enumerate(staff)])
+
+    def finished_staff(self):
+        # {kirke_id: [Staff, ...]} for every church whose page was scraped successfully
+        finished = {kirke_id: [] for (kirke_id,) in
+                    self.connection.execute("SELECT kirke_id FROM churches WHERE ok = 1")}
+        rows = self.connection.execute(
+            "SELECT kirke_id, %s FROM staff ORDER BY kirke_id, position" % ", ".join(STAFF_FIELDS))
+        for row in rows:
+            if row[0] in finished:
+                new_staff = Staff()
+                for field, value in zip(STAFF_FIELDS, row[1:]):
+                    setattr(new_staff, field, value)
+                finished[row[0]].append(new_staff)
+        return finished
+
+    def staff_of(self, kirke_id):
+        # The journalled staff of one church, or None unless its page was scraped successfully
+        row = self.connection.execute("SELECT ok FROM churches WHERE kirke_id = ?", (kirke_id,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        staff = []
+        for values in self.connection.execute(
+                "SELECT %s FROM staff WHERE kirke_id = ? ORDER BY position" % ", ".join(STAFF_FIELDS), (kirke_id,)):
+            new_staff = Staff()
+            for field, value in zip(STAFF_FIELDS, values):
+                setattr(new_staff, field, value)
+            staff.append(new_staff)
+        return staff
+
+    def failed_ids(self):
+        return {kirke_id for (kirke_id,) in self.connection.execute("SELECT kirke_id FROM churches WHERE ok = 0")}
+
+    def close(self):
+        self.connection.close()
+
+
+def resume_from_journal(kirker, journal, logger):
+    # Put the journalled staff back on finished churches and return the churches still to scrape
+    finished = journal.finished_staff()
+    failed = journal.failed_ids()
+    remaining = []
+    for kirke in kirker:
+        if kirke.kirke_id in finished:
+            kirke.staff = finished[kirke.kirke_id]
+        else:
+            remaining.append(kirke)
+    logger.info("Resuming: %s churches already scraped, %s failed churches queued for retry, %s left in total.",
+                len(kirker) - len(remaining), len([k for k in remaining if k.kirke_id in failed]), len(remaining))
+    return remaining
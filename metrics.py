@@ -0,0 +1,214 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Upper bounds of the histogram buckets; the last bucket is +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1024, 10 * 1024, 50 * 1024, 100 * 1024, 250 * 1024, 500 * 1024, 1024 * 1024)
+PROMETHEUS_PREFIX = "aipyscrape"
+
+
+def endpoint_of(url):
+    # Last path segment, e.g. 'kirker.php' or 'praester-medarb'. Keeps the label set small.
+    path = urlsplit(url).path.rstrip("/")
+    return path.rsplit("/", 1)[-1] or "/"
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for position, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[position] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, cumulative count) pairs in Prometheus order, ending with +Inf
+        running = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            running += count
+            pairs.append((bound, running))
+        return pairs
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "buckets": {("+Inf" if bound == float("inf") else str(bound)): count for bound, count in self.cumulative()},
+        }
+
+
+class Metrics:
+    # Run-wide timings and request statistics. Stages record wall and CPU time; requests record
+    # latency and size histograms, status-code counts, retries and cache outcomes per endpoint.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.stages = {}
+            self.latency = {}
+            self.sizes = {}
+            self.statuses = {}
+            self.retries = {}
+            self.cache = {}
+
+    def observe_stage(self, name, wall, cpu):
+        with self.lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0})
+            stage["calls"] += 1
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            stage["max_wall"] = max(stage["max_wall"], wall)
+
+    @contextmanager
+    def stage(self, name):
+        # For whole stages run from the main thread: CPU time covers every thread of the process
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.observe_stage(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    @contextmanager
+    def call(self, name):
+        # For per-item work inside worker threads: CPU time covers the calling thread only
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.observe_stage(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed(self, name):
+        # Decorator form of stage() for functions that are a whole stage
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def record_request(self, url, status, latency, size=None):
+        # status is the HTTP status code, or 'error' when no response came back
+        endpoint = endpoint_of(url)
+        with self.lock:
+            self.latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(latency)
+            if size is not None:
+                self.sizes.setdefault(endpoint, Histogram(SIZE_BUCKETS)).observe(size)
+            key = (endpoint, str(status))
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def record_size(self, url, size):
+        # Size of a streamed body, known only once it has been read
+        with self.lock:
+            self.sizes.setdefault(endpoint_of(url), Histogram(SIZE_BUCKETS)).observe(size)
+
+    def record_retry(self, url):
+        endpoint = endpoint_of(url)
+        with self.lock:
+            self.retries[endpoint] = self.retries.get(endpoint, 0) + 1
+
+    def record_cache(self, url, outcome):
+        # outcome is 'hit', 'revalidated' or 'miss'
+        key = (endpoint_of(url), outcome)
+        with self.lock:
+            self.cache[key] = self.cache.get(key, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            endpoints = sorted(set(self.latency) | set(self.sizes) | {e for e, _ in self.cache})
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+                "requests": {
+                    endpoint: {
+                        "latency_seconds": self.latency[endpoint].to_dict() if endpoint in self.latency else None,
+                        "response_bytes": self.sizes[endpoint].to_dict() if endpoint in self.sizes else None,
+                        "status_codes": {status: count for (e, status), count in self.statuses.items() if e == endpoint},
+                        "retries": self.retries.get(endpoint, 0),
+                        "cache": {outcome: count for (e, outcome), count in self.cache.items() if e == endpoint},
+                    }
+                    for endpoint in endpoints
+                },
+            }
+
+    def write_json(self, file_path):
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def prometheus_lines(self):
+        p = PROMETHEUS_PREFIX
+        summary = self.summary()
+        lines = [
+            "# HELP %s_last_run_timestamp_seconds End of the last run." % p,
+            "# TYPE %s_last_run_timestamp_seconds gauge" % p,
+            "%s_last_run_timestamp_seconds %s" % (p, summary["finished"]),
+            "# HELP %s_stage_wall_seconds Wall time spent in each stage during the last run." % p,
+            "# TYPE %s_stage_wall_seconds gauge" % p,
+        ]
+        for name, stage in summary["stages"].items():
+            lines.append('%s_stage_wall_seconds{stage="%s"} %s' % (p, name, stage["wall"]))
+        lines += ["# HELP %s_stage_cpu_seconds CPU time spent in each stage during the last run." % p,
+                  "# TYPE %s_stage_cpu_seconds gauge" % p]
+        for name, stage in summary["stages"].items():
+            lines.append('%s_stage_cpu_seconds{stage="%s"} %s' % (p, name, stage["cpu"]))
+        lines += ["# HELP %s_stage_calls Number of times each stage ran during the last run." % p,
+                  "# TYPE %s_stage_calls gauge" % p]
+        for name, stage in summary["stages"].items():
+            lines.append('%s_stage_calls{stage="%s"} %s' % (p, name, stage["calls"]))
+
+        with self.lock:
+            for metric, histograms, help_text in (
+                    ("request_duration_seconds", self.latency, "HTTP request latency."),
+                    ("response_size_bytes", self.sizes, "HTTP response body size.")):
+                lines += ["# HELP %s_%s %s" % (p, metric, help_text), "# TYPE %s_%s histogram" % (p, metric)]
+                for endpoint, histogram in sorted(histograms.items()):
+                    for bound, count in histogram.cumulative():
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        lines.append('%s_%s_bucket{endpoint="%s",le="%s"} %s' % (p, metric, endpoint, le, count))
+                    lines.append('%s_%s_sum{endpoint="%s"} %s' % (p, metric, endpoint, histogram.total))
+                    lines.append('%s_%s_count{endpoint="%s"} %s' % (p, metric, endpoint, histogram.count))
+            lines += ["# HELP %s_responses_total HTTP responses by status code." % p,
+                      "# TYPE %s_responses_total counter" % p]
+            for (endpoint, status), count in sorted(self.statuses.items()):
+                lines.append('%s_responses_total{endpoint="%s",status="%s"} %s' % (p, endpoint, status, count))
+            lines += ["# HELP %s_request_retries_total Retried HTTP requests." % p,
+                      "# TYPE %s_request_retries_total counter" % p]
+            for endpoint, count in sorted(self.retries.items()):
+                lines.append('%s_request_retries_total{endpoint="%s"} %s' % (p, endpoint, count))
+            lines += ["# HELP %s_cache_lookups_total Response cache outcomes." % p,
+                      "# TYPE %s_cache_lookups_total counter" % p]
+            for (endpoint, outcome), count in sorted(self.cache.items()):
+                lines.append('%s_cache_lookups_total{endpoint="%s",outcome="%s"} %s' % (p, endpoint, outcome, count))
+        return lines
+
+    def write_prometheus(self, file_path):
+        # Write to a temporary file and rename, so the node_exporter textfile collector never sees half a file
+        temp_path = file_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(self.prometheus_lines()) + "\n")
+        os.replace(temp_path, file_path)
+
+
+# Shared by the transport and the scrape stages, written out at the end of a run
+METRICS = Metrics()
@@ -0,0 +1,75 @@
+from records import KIRKE_EXPORT_FIELDS, clean_status
+
+# Columns of the 'Persons' sheet (one row per deduplicated staff member) and of the 'Person Kirker'
+# sheet linking each person to the churches whose pages list them, with the position held there
+PERSON_COLUMNS = ("person_id", "navn", "adr1", "postnr", "by", "email", "tlf", "kirke_ids")
+PERSON_KIRKE_COLUMNS = ("person_id", "kirke_id", "stilling")
+
+# 'DK-8000 Aarhus C' -> ('8000', 'Aarhus C')
+POSTNR_BY = r"^(?:DK-?)?(\d{4})\s+(.*)$"
+# A Danish number is eight digits, possibly after a country code. Spaces, dots, dashes and
+# brackets are removed first, so '+45 54 60 81 18' and '(45) 5460-8118' both give '54608118'.
+TLF_SEPARATORS = r"[\s.\-()]"
+DANISH_TLF = r"(?:^|\D)(?:\+45|0045|45)?(\d{8})(?:\D|$)"
+EMAIL = r"([^\s<>:;,]+@[^\s<>:;,]+)"
+
+
+def normalize_staff(frame):
+    # Normalise the staff columns of a KirkeTable.staff_frame() in one pass of pandas string
+    # operations: postnr_by is split into postnr and by, tlf is reduced to its digits and email
+    # is lowercased. Fields that don't fit the pattern are kept as well as possible: a postnr_by
+    # without a post number becomes the town, a foreign phone number keeps all its digits.
+    frame = frame.copy()
+    for column in ("navn", "stilling", "adr1", "postnr_by", "email", "tlf"):
+        frame[column] = frame[column].fillna("").astype(str).str.strip()
+
+    parts = frame["postnr_by"].str.extract(POSTNR_BY)
+    frame["postnr"] = parts[0].fillna("")
+    frame["by"] = parts[1].fillna(frame["postnr_by"])
+
+    tlf = frame["tlf"].str.replace(TLF_SEPARATORS, "", regex=True)
+    frame["tlf"] = tlf.str.extract(DANISH_TLF)[0].fillna(tlf.str.replace(r"\D", "", regex=True))
+
+    frame["email"] = frame["email"].str.extract(EMAIL)[0].fillna("").str.lower()
+    return frame
+
+
+def person_keys(frame):
+    # The same person is recognised by their email address and name. Neither an email address nor
+    # a phone number is enough alone, as both are often shared by an office (kontor@...sogn.dk),
+    # so the key is email and name, or without an email phone and name; with neither, the name is
+    # only matched on the same parish page (the page every church of the parish shares).
+    name = frame["navn"].str.lower().str.replace(r"\s+", " ", regex=True)
+    keys = "tlf:" + frame["tlf"] + "|" + name
+    keys = keys.where(frame["tlf"] != "", "page:" + frame["sogndk_url"].fillna("").astype(str) + "|" + name)
+    return ("email:" + frame["email"] + "|" + name).where(frame["email"] != "", keys)
+
+
+def build_person_index(frame):
+    # Deduplicate a normalised staff frame. Returns (persons, links): one row per person with
+    # the details of their first appearance and all their kirke_ids, and one row per
+    # (person, church, position). person_id numbers the persons from 1 in order of appearance.
+    import pandas as pd
+    frame = frame.assign(person_id=pd.factorize(person_keys(frame))[0] + 1)
+    links = frame[list(PERSON_KIRKE_COLUMNS)].drop_duplicates()
+    kirke_ids = (links[["person_id", "kirke_id"]].drop_duplicates()
+                 .assign(kirke_id=lambda f: f["kirke_id"].astype(str))
+                 .groupby("person_id", sort=False)["kirke_id"].agg(";".join))
+    persons = frame.drop_duplicates("person_id").set_index("person_id")
+    persons["kirke_ids"] = kirke_ids
+    persons = persons.reset_index()[list(PERSON_COLUMNS)]
+    return persons, links
+
+
+def person_sheets(table, logger):
+    # The sheets of a --persons export of a KirkeTable: every church once, every person once,
+    # and the links between them, in place of one 'Kirker and Staff' row per staff member
+    persons, links = build_person_index(normalize_staff(table.staff_frame()))
+    logger.info("%s staff rows belong to %s persons.", len(table.staff_row), len(persons))
+    kirke_columns = dict(table.kirke)
+    kirke_columns["account_status"] = [clean_status(value) for value in kirke_columns["account_status"]]
+    return [
+        ("Kirker", KIRKE_EXPORT_FIELDS, zip(*(kirke_columns[field] for field in KIRKE_EXPORT_FIELDS))),
+        ("Persons", PERSON_COLUMNS, persons.itertuples(index=False, name=None)),
+        ("Person Kirker", PERSON_KIRKE_COLUMNS, links.itertuples(index=False, name=None)),
+    ]
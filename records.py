@@ -0,0 +1,141 @@
+import math
+
+# Data attributes of a Kirke in declaration order (staff and account_status are filled in later stages)
+KIRKE_FIELDS = ("kirke_id", "kirke_navn", "kirke_addr1", "kirke_addr2", "kirke_postnr", "kirke_by",
+                "kirke_lat", "kirke_lng", "sogne_id", "sogne_navn", "sogndk_url", "provsti_id",
+                "provsti_navn")
+STAFF_FIELDS = ("stilling", "navn", "adr1", "postnr_by", "email", "tlf")
+
+# Columns of the 'Kirker and Staff' export: a few leading key columns followed by every
+# Kirke and Staff attribute, in the order the classes declare them
+KIRKE_EXPORT_FIELDS = KIRKE_FIELDS + ("account_status",)
+EXPORT_KEY_COLUMNS = (("Account Status", "account_status"), ("Sogne_id", "sogne_id"),
+                      ("Kirke_id", "kirke_id"), ("Kirke_navn", "kirke_navn"))
+EXPORT_COLUMNS = tuple(column for column, _ in EXPORT_KEY_COLUMNS) + KIRKE_EXPORT_FIELDS + STAFF_FIELDS
+
+
+class Kirke:
+    # Slotted so that several feed snapshots can be held in memory at once.
+    # Ids and the post number are ints, lat/lng are floats.
+    __slots__ = KIRKE_FIELDS + ("staff", "account_status")
+
+    def __init__(self):
+        self.kirke_id = None
+        self.kirke_navn = None
+        self.kirke_addr1 = None
+        self.kirke_addr2 = None
+        self.kirke_postnr = None
+        self.kirke_by = None
+        self.kirke_lat = None
+        self.kirke_lng = None
+        self.sogne_id = None
+        self.sogne_navn = None
+        self.sogndk_url = None
+        self.provsti_id = None
+        self.provsti_navn = None
+        self.staff = []
+        self.account_status = ""
+
+
+class Staff:
+    __slots__ = STAFF_FIELDS
+
+    def __init__(self):
+        self.stilling = None
+        self.navn = None
+        self.adr1 = None
+        self.postnr_by = None
+        self.email = None
+        self.tlf = None
+
+
+def parse_float(text):
+    return float(text) if text and text.strip() else None
+
+
+def sogne_keys(sogne_id, substring=False):
+    # The CCLI numbers that match a sogne_id: the id as text or, with substring=True, every
+    # substring of it including the empty string, i.e. every num for which `num in str(sogne_id)`
+    text = str(sogne_id)
+    if not substring:
+        return (text,)
+    return {text[i:j] for i in range(len(text) + 1) for j in range(i, len(text) + 1)}
+
+
+def clean_status(value):
+    # Statuses are text, as the store keeps them. Empty spreadsheet cells come back from pandas
+    # as NaN, and a number column with empty cells as floats, so 5.0 is read as '5'.
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return value if isinstance(value, str) else str(value)
+
+
+class KirkeTable:
+    # Column-oriented copy of a list of Kirke records and their staff. Each Kirke attribute is one
+    # list, and each staff column is one list plus `staff_row`, the position of the staff
+    # member's Kirke. The exporters get whole columns without building a dict per record.
+    __slots__ = ("kirke", "staff", "staff_row")
+
+    def __init__(self):
+        self.kirke = {field: [] for field in KIRKE_EXPORT_FIELDS}
+        self.staff = {field: [] for field in STAFF_FIELDS}
+        self.staff_row = []
+
+    @classmethod
+    def from_kirker(cls, kirker):
+        table = cls()
+        for kirke in kirker:
+            table.append(kirke)
+        return table
+
+    def __len__(self):
+        return len(self.kirke["kirke_id"])
+
+    def append(self, kirke):
+        row = len(self)
+        for field in KIRKE_EXPORT_FIELDS:
+            self.kirke[field].append(getattr(kirke, field))
+        for staff in kirke.staff:
+            for field in STAFF_FIELDS:
+                self.staff[field].append(getattr(staff, field))
+            self.staff_row.append(row)
+
+    def export_columns(self):
+        # The 'Kirker and Staff' layout: one entry per staff member, keyed by EXPORT_COLUMNS
+        columns = {}
+        for column, field in EXPORT_KEY_COLUMNS:
+            columns[column] = self.take(field)
+        for field in KIRKE_EXPORT_FIELDS:
+            columns[field] = self.take(field)
+        columns["account_status"] = [clean_status(value) for value in columns["account_status"]]
+        columns["Account Status"] = columns["account_status"]
+        for field in STAFF_FIELDS:
+            columns[field] = self.staff[field]
+        return columns
+
+    def take(self, field):
+        values = self.kirke[field]
+        return [values[row] for row in self.staff_row]
+
+    def kirke_frame(self):
+        import pandas as pd
+        return pd.DataFrame(self.kirke)
+
+    def staff_frame(self):
+        # One row per staff member, with the kirke_id and sogndk_url of their Kirke
+        import pandas as pd
+        columns = {"kirke_id": self.take("kirke_id"), "sogndk_url": self.take("sogndk_url")}
+        columns.update(self.staff)
+        return pd.DataFrame(columns, columns=["kirke_id", "sogndk_url"] + list(STAFF_FIELDS))
+
+    def to_pandas(self):
+        import pandas as pd
+        return pd.DataFrame(self.export_columns(), columns=list(EXPORT_COLUMNS))
+
+    def to_arrow(self):
+        # Needs the optional pyarrow package
+        import pyarrow as pa
+        columns = self.export_columns()
+        return pa.table([columns[column] for column in EXPORT_COLUMNS], names=list(EXPORT_COLUMNS))
@@ -0,0 +1,157 @@
+import os
+import socket
+import sqlite3
+import time
+import zlib
+
+from records import Kirke, KIRKE_FIELDS
+
+QUEUE_FILE = "queue.sqlite"
+SHARD_KEYS = ("provsti", "sogne")
+DEFAULT_SHARD_KEY = "provsti"
+DEFAULT_SHARDS = 16
+# A shard claimed longer ago than this is assumed to belong to a dead worker and is handed out again
+DEFAULT_LEASE = 3600.0
+
+
+def shard_of(kirke, key, shards):
+    # Both keys keep every church of a parish in the same shard, so each staff page is fetched once.
+    # crc32 rather than hash(), which differs between processes.
+    if key == "provsti":
+        value = kirke.provsti_id
+    else:
+        value = kirke.sogne_id
+    return zlib.crc32(str(value).encode("utf-8")) % shards
+
+
+def worker_name():
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+class ShardQueue:
+    # Work queue for a sharded scrape, kept in DIR/queue.sqlite so that worker processes on this
+    # machine, or on other hosts sharing the directory, can claim shards. The queue holds the
+    # churches of every shard, so workers don't read the feed themselves; each finished shard is
+    # exported to DIR/shard-<id>.sqlite and merged into the final export at the end. Every shard
+    # also gets its own scrape journal, so a retried shard only scrapes the pages that failed.
+    def __init__(self, directory, lease=DEFAULT_LEASE):
+        self.directory = directory
+        self.lease = lease
+        os.makedirs(directory, exist_ok=True)
+        # isolation_level=None: transactions are started explicitly, so a claim can take the write lock up front
+        self.connection = sqlite3.connect(os.path.join(directory, QUEUE_FILE), timeout=60, isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS shards (
+                shard_id INTEGER PRIMARY KEY,
+                status TEXT NOT NULL,
+                worker TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                claimed_at REAL,
+                finished_at REAL,
+                error TEXT
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS kirker (
+                shard_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                %s,
+                PRIMARY KEY (shard_id, position)
+            )""" % ", ".join(KIRKE_FIELDS))
+
+    def output_path(self, shard_id):
+        return os.path.join(self.directory, "shard-%s.sqlite" % shard_id)
+
+    def journal_path(self, shard_id):
+        return os.path.join(self.directory, "shard-%s.journal.sqlite" % shard_id)
+
+    def plan(self, kirker, key=DEFAULT_SHARD_KEY, shards=DEFAULT_SHARDS):
+        # Replace the queue with the given churches split into at most `shards` shards.
+        # Returns {shard_id: number of churches}; shards that would be empty are left out.
+        # Churches keep their position in the feed, so the merged export has the feed's order.
+        grouped = {}
+        for position, kirke in enumerate(kirker):
+            grouped.setdefault(shard_of(kirke, key, shards), []).append((position, kirke))
+        placeholders = ", ".join("?" for _ in KIRKE_FIELDS)
+        old_shards = [shard_id for (shard_id,) in self.connection.execute("SELECT shard_id FROM shards")]
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("DELETE FROM shards")
+            self.connection.execute("DELETE FROM kirker")
+            for shard_id, shard in sorted(grouped.items()):
+                self.connection.execute("INSERT INTO shards (shard_id, status) VALUES (?, 'pending')", (shard_id,))
+                self.connection.executemany(
+                    "INSERT INTO kirker VALUES (?, ?, %s)" % placeholders,
+                    [(shard_id, position) + tuple(getattr(k, field) for field in KIRKE_FIELDS)
+                     for position, k in shard])
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        for shard_id in set(old_shards) | set(grouped):
+            for path in (self.output_path(shard_id), self.journal_path(shard_id)):
+                if os.path.exists(path):
+                    os.remove(path)
+        return {shard_id: len(shard) for shard_id, shard in grouped.items()}
+
+    def claim(self, worker, retry_failed=False):
+        # Atomically take the next pending shard (or one whose lease has run out).
+        # Returns (shard_id, [Kirke, ...]), or None when there is nothing left to do.
+        statuses = ("pending", "failed") if retry_failed else ("pending",)
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT shard_id FROM shards WHERE status IN (%s) OR (status = 'claimed' AND claimed_at < ?) "
+                "ORDER BY attempts, shard_id LIMIT 1" % ", ".join("?" for _ in statuses),
+                statuses + (now - self.lease,)).fetchone()
+            if row is None:
+                self.connection.execute("COMMIT")
+                return None
+            shard_id = row[0]
+            self.connection.execute(
+                "UPDATE shards SET status = 'claimed', worker = ?, claimed_at = ?, attempts = attempts + 1, error = NULL "
+                "WHERE shard_id = ?", (worker, now, shard_id))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return shard_id, self.kirker(shard_id)
+
+    def kirker(self, shard_id):
+        kirker = []
+        rows = self.connection.execute(
+            "SELECT %s FROM kirker WHERE shard_id = ? ORDER BY position" % ", ".join(KIRKE_FIELDS), (shard_id,))
+        for row in rows:
+            kirke = Kirke()
+            for field, value in zip(KIRKE_FIELDS, row):
+                setattr(kirke, field, value)
+            kirker.append(kirke)
+        return kirker
+
+    def release(self, shard_id, worker):
+        # Hand a shard back unfinished, e.g. when its worker is interrupted
+        self.connection.execute(
+            "UPDATE shards SET status = 'pending', worker = NULL, claimed_at = NULL WHERE shard_id = ? AND worker = ?",
+            (shard_id, worker))
+
+    def finish(self, shard_id, worker, error=None):
+        # Only the worker holding the claim may finish a shard; a late worker whose lease ran out is ignored
+        self.connection.execute(
+            "UPDATE shards SET status = ?, finished_at = ?, error = ? WHERE shard_id = ? AND worker = ?",
+            ("failed" if error else "done", time.time(), error, shard_id, worker))
+
+    def status(self):
+        # {status: number of shards}
+        return dict(self.connection.execute("SELECT status, COUNT(*) FROM shards GROUP BY status"))
+
+    def feed_order(self):
+        # {kirke_id: position in the feed}
+        return dict(self.connection.execute("SELECT kirke_id, position FROM kirker"))
+
+    def finished_outputs(self):
+        # Output files of the finished shards, in shard order
+        return [self.output_path(shard_id) for (shard_id,) in
+                self.connection.execute("SELECT shard_id FROM shards WHERE status = 'done' ORDER BY shard_id")]
+
+    def close(self):
+        self.connection.close()
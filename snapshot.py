@@ -0,0 +1,161 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+
+from records import Staff, STAFF_FIELDS
+
+DEFAULT_SNAPSHOT_PATH = "staff_snapshot.sqlite"
+
+# Columns of the 'Changes' sheet: what happened, to which church, the staff member as it is now
+# (as it was, for removed staff), and for modified staff the fields that changed and their old values
+CHANGE_COLUMNS = ("change", "kirke_id", "kirke_navn", "sogne_id") + STAFF_FIELDS + ("changed_fields", "previous_values")
+
+PERSON_DATA_START = re.compile(rb"<div[^>]*class=[\"'][^\"']*\bperson_data\b")
+DIV_TAG = re.compile(rb"<div\b|</div\s*>", re.IGNORECASE)
+
+
+def person_data_block(content):
+    # The markup from the first person_data block to the end of the last one, found by balancing
+    # the <div> tags after the last block starts. The rest of the page (menus, tokens, dates)
+    # changes without the staff changing, so only this part is hashed.
+    starts = list(PERSON_DATA_START.finditer(content))
+    if not starts:
+        return b""
+    depth = 0
+    end = len(content)
+    for tag in DIV_TAG.finditer(content, starts[-1].start()):
+        depth += -1 if tag.group().startswith(b"</") else 1
+        if depth == 0:
+            end = tag.end()
+            break
+    return content[starts[0].start():end]
+
+
+def person_data_hash(content):
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    return hashlib.sha256(person_data_block(content)).hexdigest()
+
+
+def staff_key(staff):
+    # Staff are matched by name; a name that appears twice on a page is matched in order
+    seen = {}
+    keyed = {}
+    for s in staff:
+        occurrence = seen.get(s.navn, 0)
+        seen[s.navn] = occurrence + 1
+        keyed[(s.navn, occurrence)] = s
+    return keyed
+
+
+def diff_staff(old, new):
+    # Yields (change, staff, changed_fields, previous_values) for the differences between two staff lists
+    old_keyed = staff_key(old)
+    new_keyed = staff_key(new)
+    for key, s in new_keyed.items():
+        previous = old_keyed.get(key)
+        if previous is None:
+            yield "added", s, "", ""
+            continue
+        changed = [field for field in STAFF_FIELDS if getattr(previous, field) != getattr(s, field)]
+        if changed:
+            yield ("modified", s, ", ".join(changed),
+                   "; ".join("%s: %s" % (field, getattr(previous, field)) for field in changed))
+    for key, s in old_keyed.items():
+        if key not in new_keyed:
+            yield "removed", s, "", ""
+
+
+class StaffSnapshot:
+    # Local SQLite copy of the last completed scrape: for every parish page the hash of its
+    # person_data markup and the staff extracted from it. A page whose hash is unchanged is not
+    # parsed again, and the staff of this run are compared with the snapshot for the change report.
+    # This run's pages are kept in memory until save(), so an interrupted run leaves the snapshot alone.
+    def __init__(self, path=DEFAULT_SNAPSHOT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.current = {}
+        self.reused = 0
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pages (
+                sogndk_url TEXT PRIMARY KEY,
+                content_hash TEXT,
+                scraped_at REAL NOT NULL
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS staff (
+                sogndk_url TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                %s,
+                PRIMARY KEY (sogndk_url, position)
+            )""" % ", ".join("%s TEXT" % field for field in STAFF_FIELDS))
+        self.connection.commit()
+        self.previous = self.load()
+
+    def load(self):
+        # {sogndk_url: (content_hash, [Staff, ...])}
+        previous = {url: (content_hash, []) for url, content_hash in
+                    self.connection.execute("SELECT sogndk_url, content_hash FROM pages")}
+        rows = self.connection.execute(
+            "SELECT sogndk_url, %s FROM staff ORDER BY sogndk_url, position" % ", ".join(STAFF_FIELDS))
+        for row in rows:
+            if row[0] in previous:
+                new_staff = Staff()
+                for field, value in zip(STAFF_FIELDS, row[1:]):
+                    setattr(new_staff, field, value)
+                previous[row[0]][1].append(new_staff)
+        return previous
+
+    def lookup(self, url, content):
+        # Returns (content_hash, staff). staff is the previous staff list when the person_data
+        # markup is unchanged, and None when the page has to be parsed.
+        content_hash = person_data_hash(content)
+        previous_hash, staff = self.previous.get(url, (None, None))
+        if previous_hash is None or previous_hash != content_hash:
+            return content_hash, None
+        with self.lock:
+            self.reused += 1
+        return content_hash, list(staff)
+
+    def record(self, url, content_hash, staff):
+        # content_hash is None for staff that didn't come from a page, e.g. restored from the journal
+        with self.lock:
+            self.current[url] = (content_hash, staff)
+
+    def changes(self, kirker, logger):
+        # Rows of the 'Changes' sheet for every church whose page was scraped in this run.
+        # The first run has nothing to compare with and reports no changes.
+        if not self.previous:
+            logger.info("No earlier snapshot in %s; this run is the baseline for the change report.", self.path)
+            return []
+        rows = []
+        for kirke in kirker:
+            if kirke.sogndk_url not in self.current:
+                continue
+            old = self.previous.get(kirke.sogndk_url, (None, []))[1]
+            for change, s, changed_fields, previous_values in diff_staff(old, self.current[kirke.sogndk_url][1]):
+                rows.append((change, kirke.kirke_id, kirke.kirke_navn, kirke.sogne_id) +
+                            tuple(getattr(s, field) for field in STAFF_FIELDS) + (changed_fields, previous_values))
+        logger.info("%s staff changes since the last snapshot.", len(rows))
+        return rows
+
+    def save(self):
+        # Replace the snapshot of every page scraped in this run
+        now = time.time()
+        placeholders = ", ".join("?" for _ in STAFF_FIELDS)
+        with self.lock, self.connection:
+            for url, (content_hash, staff) in self.current.items():
+                self.connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", (url, content_hash, now))
+                self.connection.execute("DELETE FROM staff WHERE sogndk_url = ?", (url,))
+                self.connection.executemany(
+                    "INSERT INTO staff VALUES (?, ?, %s)" % placeholders,
+                    [(url, position) + tuple(getattr(s, field) for field in STAFF_FIELDS)
+                     for position, s in enumerate(staff)])
+            self.previous.update(self.current)
+            self.current = {}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,172 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+# Side of a grid cell. With Denmark's roughly 2400 churches on 43,000 km2 this puts a handful of
+# churches in each occupied cell, so most queries look at one block of nine cells.
+DEFAULT_CELL_KM = 10.0
+# Great-circle distances are a little shorter than distances along a parallel, so ring bounds
+# are shrunk by this factor before they are trusted
+RING_MARGIN = 0.99
+
+
+def haversine_km(lat, lng, lats, lngs):
+    # Distance in km from one point to arrays of points
+    lat1 = np.radians(lat)
+    lat2 = np.radians(lats)
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+         np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(lngs - lng) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class ChurchIndex:
+    # Uniform grid over kirke_lat/kirke_lng for nearest, radius and bounding-box queries. The
+    # coordinates are held in NumPy arrays sorted by grid cell, so the churches of a row of cells
+    # are one contiguous slice found with searchsorted, and each query only measures the distance
+    # to the churches of the cells around it. Churches without coordinates are left out.
+    def __init__(self, kirker, cell_km=DEFAULT_CELL_KM):
+        located = [k for k in kirker if k.kirke_lat is not None and k.kirke_lng is not None]
+        self.cell_km = cell_km
+        self.kirker = located
+        self.lat = np.array([k.kirke_lat for k in located], dtype=float)
+        self.lng = np.array([k.kirke_lng for k in located], dtype=float)
+        if not located:
+            self.lat0 = self.lng0 = 0.0
+            self.cell_lat = self.cell_lng = 1.0
+            self.rows = self.columns = 1
+            self.order = np.zeros(0, dtype=np.intp)
+            self.codes = np.zeros(0, dtype=np.int64)
+            return
+        # A cell is cell_km high, and at least cell_km wide at every latitude in the data
+        widest = math.cos(math.radians(min(np.abs(self.lat).max(), 89.0)))
+        self.cell_lat = cell_km / KM_PER_DEGREE
+        self.cell_lng = cell_km / (KM_PER_DEGREE * widest)
+        self.lat0 = self.lat.min()
+        self.lng0 = self.lng.min()
+        rows, columns = self.cell_of(self.lat, self.lng)
+        self.rows = int(rows.max()) + 1
+        self.columns = int(columns.max()) + 1
+        codes = rows.astype(np.int64) * self.columns + columns
+        self.order = np.argsort(codes, kind="stable")
+        self.codes = codes[self.order]
+
+    def __len__(self):
+        return len(self.kirker)
+
+    def cell_of(self, lat, lng):
+        return (np.floor((np.asarray(lat) - self.lat0) / self.cell_lat).astype(np.int64),
+                np.floor((np.asarray(lng) - self.lng0) / self.cell_lng).astype(np.int64))
+
+    def candidates(self, row_from, row_to, column_from, column_to):
+        # Positions of the churches in a block of cells (bounds inclusive, clipped to the grid)
+        row_from = max(row_from, 0)
+        row_to = min(row_to, self.rows - 1)
+        column_from = max(column_from, 0)
+        column_to = min(column_to, self.columns - 1)
+        if row_from > row_to or column_from > column_to:
+            return np.zeros(0, dtype=np.intp)
+        rows = np.arange(row_from, row_to + 1, dtype=np.int64) * self.columns
+        starts = np.searchsorted(self.codes, rows + column_from, side="left")
+        ends = np.searchsorted(self.codes, rows + column_to, side="right")
+        return np.concatenate([self.order[start:end] for start, end in zip(starts, ends)])
+
+    def nearest_positions(self, lat, lng, k=1):
+        # Search a growing block of cells around the point until it holds k churches that are
+        # certainly nearer than anything outside it. Returns (positions, distances), nearest first.
+        k = min(k, len(self))
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+        row, column = (int(value) for value in self.cell_of(lat, lng))
+        ring = 1
+        while True:
+            found = self.candidates(row - ring, row + ring, column - ring, column + ring)
+            covers_grid = (row - ring <= 0 and column - ring <= 0 and
+                           row + ring >= self.rows - 1 and column + ring >= self.columns - 1)
+            if len(found) >= k or covers_grid:
+                distances = haversine_km(lat, lng, self.lat[found], self.lng[found])
+                nearest = np.argsort(distances, kind="stable")[:k]
+                # Anything outside the block is more than `ring` cells away
+                if covers_grid or distances[nearest[-1]] <= ring * self.cell_km * RING_MARGIN:
+                    return found[nearest], distances[nearest]
+            ring *= 2
+
+    def radius_positions(self, lat, lng, radius_km):
+        # (positions, distances) of the churches within radius_km of the point, nearest first
+        rows = int(math.ceil(radius_km / self.cell_km / RING_MARGIN))
+        row, column = (int(value) for value in self.cell_of(lat, lng))
+        found = self.candidates(row - rows, row + rows, column - rows, column + rows)
+        distances = haversine_km(lat, lng, self.lat[found], self.lng[found])
+        inside = distances <= radius_km
+        found = found[inside]
+        distances = distances[inside]
+        nearest = np.argsort(distances, kind="stable")
+        return found[nearest], distances[nearest]
+
+    def bbox_positions(self, south, west, north, east):
+        # Positions of the churches inside the box, in feed order
+        row_from, column_from = (int(value) for value in self.cell_of(south, west))
+        row_to, column_to = (int(value) for value in self.cell_of(north, east))
+        found = self.candidates(row_from, row_to, column_from, column_to)
+        lat = self.lat[found]
+        lng = self.lng[found]
+        return np.sort(found[(lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)])
+
+    def nearest(self, lat, lng, k=1):
+        # [(Kirke, distance in km), ...] for the k churches nearest to the point, nearest first
+        positions, distances = self.nearest_positions(lat, lng, k)
+        return [(self.kirker[p], float(d)) for p, d in zip(positions, distances)]
+
+    def within(self, lat, lng, radius_km):
+        # [(Kirke, distance in km), ...] for the churches within radius_km of the point, nearest first
+        positions, distances = self.radius_positions(lat, lng, radius_km)
+        return [(self.kirker[p], float(d)) for p, d in zip(positions, distances)]
+
+    def in_bbox(self, south, west, north, east):
+        return [self.kirker[p] for p in self.bbox_positions(south, west, north, east)]
+
+
+class Region:
+    # A bounding box (south, west, north, east), a circle (lat, lng, radius in km), or both, that
+    # a run can be restricted to. Churches without coordinates are outside every region.
+    def __init__(self, bbox=None, circle=None):
+        self.bbox = bbox
+        self.circle = circle
+
+    def __str__(self):
+        parts = []
+        if self.bbox:
+            parts.append("box %s,%s,%s,%s" % self.bbox)
+        if self.circle:
+            parts.append("%s km around %s,%s" % (self.circle[2], self.circle[0], self.circle[1]))
+        return " and ".join(parts)
+
+    def contains(self, kirke):
+        # One church at a time, for streaming runs
+        lat, lng = kirke.kirke_lat, kirke.kirke_lng
+        if lat is None or lng is None:
+            return False
+        if self.bbox:
+            south, west, north, east = self.bbox
+            if not (south <= lat <= north and west <= lng <= east):
+                return False
+        if self.circle:
+            center_lat, center_lng, radius_km = self.circle
+            if haversine_km(center_lat, center_lng, lat, lng) > radius_km:
+                return False
+        return True
+
+    def select(self, kirker, index=None):
+        # The churches of kirker inside the region, in their original order
+        if index is None:
+            index = ChurchIndex(kirker)
+        positions = None
+        if self.bbox:
+            positions = index.bbox_positions(*self.bbox)
+        if self.circle:
+            inside = np.sort(index.radius_positions(*self.circle)[0])
+            positions = inside if positions is None else np.intersect1d(positions, inside)
+        if positions is None:
+            return list(kirker)
+        return [index.kirker[p] for p in positions]
@@ -0,0 +1,163 @@
+import sqlite3
+import time
+
+from records import Kirke, Staff, KIRKE_FIELDS, STAFF_FIELDS, sogne_keys
+
+DEFAULT_STORE_PATH = "kirker_store.sqlite"
+
+# SQLite types of the Kirke columns; the rest are TEXT
+KIRKE_COLUMN_TYPES = {
+    "kirke_id": "INTEGER PRIMARY KEY",
+    "kirke_postnr": "INTEGER",
+    "kirke_lat": "REAL",
+    "kirke_lng": "REAL",
+    "sogne_id": "INTEGER",
+    "provsti_id": "INTEGER",
+}
+STORE_KIRKE_FIELDS = KIRKE_FIELDS + ("account_status",)
+# Churches are written in transactions of this many, so a streaming run doesn't hold one open throughout
+SAVE_BATCH = 1000
+# Staff emails are matched case-insensitively and without surrounding whitespace; the index is on this expression
+EMAIL_KEY = "lower(trim(email))"
+
+
+class KirkeStore:
+    # Local SQLite copy of the scraped churches and their staff, indexed on kirke_id, sogne_id,
+    # provsti_id and staff email, so single churches, parishes, deaneries and people are looked
+    # up without reading a whole export. Saving a church replaces its earlier details and staff,
+    # but keeps its Account Status unless the new one is set: a fresh scrape doesn't know the
+    # statuses, which are joined in afterwards with apply_status_index().
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS kirker (
+                %s,
+                saved_at REAL NOT NULL
+            )""" % ", ".join("%s %s" % (field, KIRKE_COLUMN_TYPES.get(field, "TEXT")) for field in STORE_KIRKE_FIELDS))
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS staff (
+                kirke_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                %s,
+                PRIMARY KEY (kirke_id, position)
+            )""" % ", ".join("%s TEXT" % field for field in STAFF_FIELDS))
+        self.connection.execute("CREATE INDEX IF NOT EXISTS kirker_sogne_id ON kirker (sogne_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS kirker_provsti_id ON kirker (provsti_id)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS staff_email ON staff (%s)" % EMAIL_KEY)
+        self.connection.commit()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM kirker").fetchone()[0]
+
+    def save_batch(self, kirker, staff=True):
+        # With staff=False (a --no-staff run) the stored staff are left as they are
+        now = time.time()
+        columns = ", ".join(STORE_KIRKE_FIELDS)
+        updates = ", ".join("%s = excluded.%s" % (field, field) for field in KIRKE_FIELDS)
+        staff_placeholders = ", ".join("?" for _ in STAFF_FIELDS)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO kirker (%s, saved_at) VALUES (%s, ?) ON CONFLICT (kirke_id) DO UPDATE SET %s, "
+                "account_status = CASE WHEN excluded.account_status != '' THEN excluded.account_status "
+                "ELSE kirker.account_status END, saved_at = excluded.saved_at"
+                % (columns, ", ".join("?" for _ in STORE_KIRKE_FIELDS), updates),
+                [tuple(getattr(k, field) for field in STORE_KIRKE_FIELDS) + (now,) for k in kirker])
+            if staff:
+                self.connection.executemany("DELETE FROM staff WHERE kirke_id = ?", [(k.kirke_id,) for k in kirker])
+                self.connection.executemany(
+                    "INSERT INTO staff VALUES (?, ?, %s)" % staff_placeholders,
+                    [(k.kirke_id, position) + tuple(getattr(s, field) for field in STAFF_FIELDS)
+                     for k in kirker for position, s in enumerate(k.staff)])
+
+    def save(self, kirker, staff=True):
+        # Returns the number of churches saved
+        count = 0
+        batch = []
+        for kirke in kirker:
+            batch.append(kirke)
+            if len(batch) >= SAVE_BATCH:
+                self.save_batch(batch, staff)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.save_batch(batch, staff)
+            count += len(batch)
+        return count
+
+    def saving(self, kirker, staff=True):
+        # Generator: save each Kirke of a streaming run as it passes through
+        batch = []
+        for kirke in kirker:
+            batch.append(kirke)
+            if len(batch) >= SAVE_BATCH:
+                self.save_batch(batch, staff)
+                batch = []
+            yield kirke
+        if batch:
+            self.save_batch(batch, staff)
+
+    def kirker(self, kirke_ids=None, sogne_id=None, provsti_id=None, email=None):
+        # Churches with their staff, in kirke_id order. Every filter that is given must match;
+        # email selects the churches that list a staff member with that address.
+        conditions = []
+        parameters = []
+        if kirke_ids is not None:
+            kirke_ids = list(kirke_ids)
+            conditions.append("kirke_id IN (%s)" % ", ".join("?" for _ in kirke_ids))
+            parameters.extend(kirke_ids)
+        if sogne_id is not None:
+            conditions.append("sogne_id = ?")
+            parameters.append(sogne_id)
+        if provsti_id is not None:
+            conditions.append("provsti_id = ?")
+            parameters.append(provsti_id)
+        if email is not None:
+            conditions.append("kirke_id IN (SELECT kirke_id FROM staff WHERE %s = ?)" % EMAIL_KEY)
+            parameters.append(email.strip().lower())
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        kirker = {}
+        for row in self.connection.execute(
+                "SELECT %s FROM kirker%s ORDER BY kirke_id" % (", ".join(STORE_KIRKE_FIELDS), where), parameters):
+            kirke = Kirke()
+            for field, value in zip(STORE_KIRKE_FIELDS, row):
+                setattr(kirke, field, value)
+            kirke.account_status = kirke.account_status or ""
+            kirker[kirke.kirke_id] = kirke
+        if not kirker:
+            return []
+        # The staff of the selected churches, through the primary key
+        staff_where = "kirke_id IN (SELECT kirke_id FROM kirker%s)" % where
+        for row in self.connection.execute(
+                "SELECT kirke_id, %s FROM staff WHERE %s ORDER BY kirke_id, position"
+                % (", ".join(STAFF_FIELDS), staff_where), parameters):
+            new_staff = Staff()
+            for field, value in zip(STAFF_FIELDS, row[1:]):
+                setattr(new_staff, field, value)
+            kirker[row[0]].staff.append(new_staff)
+        return list(kirker.values())
+
+    def kirke(self, kirke_id):
+        found = self.kirker(kirke_ids=[kirke_id])
+        return found[0] if found else None
+
+    def apply_status_index(self, index, substring=False):
+        # Set the Account Status of the stored churches from a CCLI number index
+        # ({number: (row, status)}, see build_status_index). Matches like import_account_status:
+        # the number equals the sogne_id, or with substring=True is contained in it, and the last
+        # matching row wins. Each church's sogne_keys are looked up in the index, so this is linear
+        # in the number of churches, and the changes go to SQLite in one executemany.
+        # Returns (numbers that matched a church, numbers that didn't).
+        updates = []
+        matched = set()
+        for kirke_id, sogne_id in self.connection.execute("SELECT kirke_id, sogne_id FROM kirker"):
+            keys = [key for key in sogne_keys(sogne_id, substring) if key in index]
+            if keys:
+                matched.update(keys)
+                updates.append((max(index[key] for key in keys)[1], kirke_id))
+        with self.connection:
+            self.connection.executemany("UPDATE kirker SET account_status = ? WHERE kirke_id = ?", updates)
+        return len(matched), len(index) - len(matched)
+
+    def close(self):
+        self.connection.close()